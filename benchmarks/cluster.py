@@ -0,0 +1,291 @@
+"""
+Launch a cluster of local nodes on loopback and drive it with a transaction and mining workload.
+The first node is the leader: it holds the wallets which send the transactions and mines the blocks.
+The other nodes follow it through /node/consensus, i.e. Blockchain.reach_consensus.
+
+Reports the rate of accepted transactions, the confirmation throughput, the end-to-end confirmation
+latency from submission until the transaction is in a mined block, and the time until all followers
+converged on the tip of the leader. Everything runs offline on this machine.
+
+Usage: python -m benchmarks.cluster [--nodes 3] [--wallets 20] [--transactions 500] [--block-interval 0.5]
+       [--consensus-every 1] [--convergence-timeout 30] [--workers 0]
+"""
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
+import requests
+
+from src.proof_of_work import ProofOfWork
+from src.transaction import Transaction
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+class Cluster:
+    """
+    Local nodes started with main.py, each in its own process and with its own data directory.
+    """
+
+    def __init__(self, number_of_nodes, workers=0):
+        self.data_root = tempfile.TemporaryDirectory()
+        self.processes = []
+        self.urls = []
+
+        for number in range(number_of_nodes):
+            port = free_port()
+            command = [sys.executable, 'main.py', '--host', '127.0.0.1', '--port', str(port),
+                       '--data-dir', os.path.join(self.data_root.name, f'node{number}'), '--workers', str(workers)]
+            self.processes.append(subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL,
+                                                   stderr=subprocess.DEVNULL))
+            self.urls.append(f'http://127.0.0.1:{port}')
+
+        for url in self.urls:
+            self.wait_until_ready(url)
+
+        # Every node knows every other node
+        for url in self.urls:
+            requests.post(f'{url}/node/register', json={'nodes': [other for other in self.urls if other != url]})
+
+    @staticmethod
+    def wait_until_ready(url, timeout=30.0):
+        deadline = perf_counter() + timeout
+        while perf_counter() < deadline:
+            try:
+                requests.get(f'{url}/node/status', timeout=1.0)
+                return
+            except requests.ConnectionError:
+                sleep(0.1)
+        raise RuntimeError(f'Node {url} did not start')
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+        self.data_root.cleanup()
+
+
+def mine_block(url, address=None):
+    """
+    Mine one block on a node like an external miner.
+    :param url: <str> URL of the node
+    :param address: (Optional) <str> Address which receives the block reward, the wallet of the node if None
+    :return: <dict> The mined block or None if the template went stale
+    """
+
+    params = {'address': address} if address else {}
+    template = requests.get(f'{url}/mining/template', params=params).json()
+    nonce = ProofOfWork.proof_of_work(template['transactions_hash'], template['previous_block_hash'])
+
+    response = requests.post(f'{url}/mining/submit', json={
+        'transactions_hash': template['transactions_hash'],
+        'previous_block_hash': template['previous_block_hash'],
+        'nonce': nonce
+    })
+    if response.status_code != 201:
+        return None
+    return requests.get(f'{url}/block/{response.json()["hash"]}').json()
+
+
+class Workload:
+    """
+    Every wallet sends one coin to a random other wallet, waits until the transaction is
+    confirmed and sends the next one, because the mempool holds one transaction per sender.
+    A mining thread mines blocks on the leader and lets the followers catch up.
+    """
+
+    # Pause between the consensus requests of a follower which is not on the tip yet
+    CONSENSUS_RETRY_INTERVAL = 0.1
+
+    def __init__(self, cluster, wallets, transactions, block_interval, consensus_every, convergence_timeout=30.0):
+        self.leader = cluster.urls[0]
+        self.followers = cluster.urls[1:]
+        self.wallets = wallets
+        self.transactions = transactions
+        self.block_interval = block_interval
+        self.consensus_every = consensus_every
+        self.convergence_timeout = convergence_timeout
+
+        # txid -> (submission time, event set when the transaction is confirmed)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+        self.submitted = 0
+        self.rejected = 0
+        self.latencies = []
+        self.convergence_times = []
+        # Rounds in which a follower did not reach the tip before the convergence timeout
+        self.unconverged_rounds = 0
+        self.blocks = 0
+
+    def send_transactions(self, sender):
+        while not self.done.is_set():
+            with self.lock:
+                if self.submitted >= self.transactions:
+                    return
+                self.submitted += 1
+
+            recipient = random.choice([wallet for wallet in self.wallets if wallet != sender])
+            confirmed = threading.Event()
+            start = perf_counter()
+            response = requests.post(f'{self.leader}/transaction/new',
+                                     json={'sender': sender, 'recipient': recipient, 'amount': 1})
+
+            if response.status_code != 201:
+                # E.g. the wallet spent all its coins, try again after the next block
+                with self.lock:
+                    self.rejected += 1
+                sleep(self.block_interval or 0.1)
+                continue
+
+            with self.lock:
+                self.pending[response.json()['txid']] = (start, confirmed)
+            confirmed.wait()
+
+    def mine(self):
+        while not self.done.is_set():
+            block = mine_block(self.leader)
+            if block is None:
+                continue
+
+            now = perf_counter()
+            self.blocks += 1
+            with self.lock:
+                for transaction in block['block']['transactions']:
+                    entry = self.pending.pop(Transaction.from_dict(transaction).txid, None)
+                    if entry is not None:
+                        start, confirmed = entry
+                        self.latencies.append(now - start)
+                        confirmed.set()
+
+                if len(self.latencies) >= self.transactions - self.rejected:
+                    self.done.set()
+
+            if self.followers and self.consensus_every and self.blocks % self.consensus_every == 0:
+                self.converge(block['hash'])
+
+            sleep(self.block_interval)
+
+        # Release senders whose transactions are still waiting
+        with self.lock:
+            for _, confirmed in self.pending.values():
+                confirmed.set()
+
+    def converge(self, tip_hash):
+        """
+        Let all followers run the consensus algorithm until they have the tip of the leader.
+        A round in which a follower does not get there before the convergence timeout is counted
+        as unconverged and not timed.
+        :param tip_hash: <str> Hash of the last block of the leader
+        :return: None
+        """
+
+        start = perf_counter()
+        deadline = start + self.convergence_timeout
+
+        def follow(url):
+            while perf_counter() < deadline:
+                try:
+                    # A request may take at most the time left until the deadline
+                    status = requests.get(f'{url}/node/status', timeout=max(deadline - perf_counter(), 0.001))
+                    if status.json()['tip_hash'] == tip_hash:
+                        return True
+                    requests.get(f'{url}/node/consensus', timeout=max(deadline - perf_counter(), 0.001))
+                except (requests.RequestException, ValueError):
+                    # E.g. the request timed out at the deadline, the loop ends below
+                    pass
+                sleep(self.CONSENSUS_RETRY_INTERVAL)
+            return False
+
+        with ThreadPoolExecutor(max_workers=len(self.followers)) as executor:
+            converged = all(list(executor.map(follow, self.followers)))
+
+        if converged:
+            self.convergence_times.append(perf_counter() - start)
+        else:
+            self.unconverged_rounds += 1
+
+    def run(self):
+        start = perf_counter()
+
+        miner = threading.Thread(target=self.mine)
+        miner.start()
+        with ThreadPoolExecutor(max_workers=len(self.wallets)) as executor:
+            list(executor.map(self.send_transactions, self.wallets))
+        self.done.set()
+        miner.join()
+
+        return perf_counter() - start
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description='Drive a local cluster of nodes with a transaction workload.')
+    parser.add_argument('--nodes', type=int, default=3, help='Number of nodes')
+    parser.add_argument('--wallets', type=int, default=20, help='Number of sending wallets')
+    parser.add_argument('--transactions', type=int, default=500, help='Number of transactions to send')
+    parser.add_argument('--block-interval', type=float, default=0.5, help='Pause between mined blocks in seconds')
+    parser.add_argument('--consensus-every', type=int, default=1,
+                        help='Let the followers catch up every n blocks, 0 never')
+    parser.add_argument('--convergence-timeout', type=float, default=30.0,
+                        help='Seconds the followers get to reach the tip of the leader in a round')
+    parser.add_argument('--workers', type=int, default=0, help='Reader worker processes per node')
+    args = parser.parse_args()
+
+    cluster = Cluster(args.nodes, args.workers)
+    try:
+        leader = cluster.urls[0]
+
+        # Fund the wallets with the reward of one block each
+        wallets = [requests.get(f'{leader}/wallet/new').json()['new_address'] for _ in range(args.wallets)]
+        for wallet in wallets:
+            mine_block(leader, wallet)
+
+        workload = Workload(cluster, wallets, args.transactions, args.block_interval, args.consensus_every,
+                            args.convergence_timeout)
+        elapsed = workload.run()
+    finally:
+        cluster.stop()
+
+    accepted = workload.submitted - workload.rejected
+    confirmed = len(workload.latencies)
+    print(f'{args.nodes} nodes, {args.wallets} wallets, {args.workers} reader workers per node, '
+          f'block interval {args.block_interval} s')
+    print(f'accepted {accepted} transactions ({workload.rejected} rejected) in {elapsed:.2f} s, '
+          f'{accepted / elapsed:.1f} tx/s')
+    print(f'confirmed {confirmed} transactions in {workload.blocks} blocks, {confirmed / elapsed:.1f} tx/s')
+    print(f'confirmation latency ms: p50 {percentile(workload.latencies, 0.5) * 1000:.0f}, '
+          f'p90 {percentile(workload.latencies, 0.9) * 1000:.0f}, '
+          f'p99 {percentile(workload.latencies, 0.99) * 1000:.0f}, max {max(workload.latencies, default=0) * 1000:.0f}')
+    if workload.convergence_times:
+        print(f'consensus convergence ms over {len(workload.convergence_times)} rounds: '
+              f'p50 {percentile(workload.convergence_times, 0.5) * 1000:.0f}, '
+              f'max {max(workload.convergence_times) * 1000:.0f}')
+    if workload.unconverged_rounds:
+        print(f'{workload.unconverged_rounds} consensus rounds did not converge within '
+              f'{args.convergence_timeout} s')
+
+
+if __name__ == '__main__':
+    main_benchmark()
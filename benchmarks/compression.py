@@ -0,0 +1,94 @@
+"""
+Measure bytes on the wire and sync time of /chain with and without compression.
+Serves a large synthetic chain from the node on a local test server and downloads it
+like Blockchain.download_chain does. Validation is left out, it costs the same for every encoding.
+
+Loopback is much faster than a real link, an optional bandwidth in Mbit/s throttles the client.
+
+Usage: python -m benchmarks.compression [number_of_blocks] [transactions_per_block] [mbit_per_second]
+"""
+import logging
+import sys
+import threading
+from time import perf_counter, sleep
+
+import requests
+from werkzeug.serving import make_server
+
+import main
+from benchmarks.memory_per_block import synthetic_block_dicts
+from src import compression
+from src.block import Block
+from src.cache import ResponseCache
+from src.chain_stream import iter_chain_blocks
+
+
+def download(url, encoding, mbit_per_second=None):
+    """
+    Download and parse a chain.
+    :param url: <str> URL of the /chain endpoint
+    :param encoding: <str> Requested content encoding or None
+    :param mbit_per_second: (Optional) <float> Simulated bandwidth of the link
+    :return: bytes: <int> Bytes received, blocks: <int> Number of parsed blocks
+    """
+
+    received = 0
+    blocks = 0
+
+    headers = {'Accept-Encoding': encoding or 'identity'}
+    with requests.get(url, headers=headers, stream=True) as response:
+        def raw_chunks():
+            nonlocal received
+            for chunk in response.raw.stream(64 * 1024, decode_content=False):
+                received += len(chunk)
+                if mbit_per_second:
+                    sleep(len(chunk) * 8 / (mbit_per_second * 1e6))
+                yield chunk
+
+        chunks = compression.decompress_chunks(raw_chunks(), response.headers.get('Content-Encoding'))
+        for block in iter_chain_blocks(chunks):
+            Block.from_dict(block)
+            blocks += 1
+
+    return received, blocks
+
+
+def main_benchmark():
+    number_of_blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    transactions_per_block = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    mbit_per_second = float(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    chain = [Block.from_dict(block) for block in synthetic_block_dicts(number_of_blocks, transactions_per_block)]
+    with main.blockchain.lock:
+        main.blockchain.replace_chain(chain)
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, main.node, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/chain'
+
+    print(f'{number_of_blocks} blocks with {transactions_per_block} transactions each, '
+          f'bandwidth {f"{mbit_per_second} Mbit/s" if mbit_per_second else "unlimited"}')
+    print(f'{"encoding":10} {"bytes":>12} {"ratio":>7} {"cold s":>8} {"warm s":>8}')
+
+    uncompressed = None
+    for encoding in (None,) + compression.ENCODINGS:
+        # Cold: the node serializes and compresses, warm: the response comes from the cache
+        main.response_cache = ResponseCache()
+        start = perf_counter()
+        received, blocks = download(url, encoding, mbit_per_second)
+        cold = perf_counter() - start
+
+        start = perf_counter()
+        download(url, encoding, mbit_per_second)
+        warm = perf_counter() - start
+
+        assert blocks == number_of_blocks
+        uncompressed = uncompressed or received
+        print(f'{encoding or "identity":10} {received:12d} {received / uncompressed:7.3f} {cold:8.3f} {warm:8.3f}')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,74 @@
+"""
+Measure the memory used per block by dict based blocks and by Block/Transaction objects.
+
+Usage: python -m benchmarks.memory_per_block [number_of_blocks] [transactions_per_block]
+"""
+import hashlib
+import sys
+import tracemalloc
+from time import time
+
+from src.block import Block
+
+
+def synthetic_block_dicts(number_of_blocks, transactions_per_block):
+    """
+    Generate blocks in their JSON representation with unique hashes, addresses and signatures.
+    :param number_of_blocks: <int> Number of blocks
+    :param transactions_per_block: <int> Number of transactions per block
+    :return: <generator> Blocks as dicts
+    """
+
+    for index in range(1, number_of_blocks + 1):
+        transactions = []
+        for position in range(transactions_per_block):
+            seed = f'{index}:{position}'.encode()
+            transactions.append({
+                'sender': hashlib.sha1(seed + b's').hexdigest()[:34],
+                'recipient': hashlib.sha1(seed + b'r').hexdigest()[:34],
+                'amount': position,
+                'signature': hashlib.sha512(seed).hexdigest()[:88]
+            })
+        yield {
+            'index': index,
+            'timestamp': time(),
+            'nonce': index * 7919,
+            'transactions_hash': hashlib.sha256(f't{index}'.encode()).hexdigest(),
+            'previous_block_hash': hashlib.sha256(f'p{index}'.encode()).hexdigest(),
+            'transactions': transactions
+        }
+
+
+def measure(build, number_of_blocks, transactions_per_block):
+    """
+    Build a chain and return the number of bytes allocated per block.
+    :param build: <function> Converts a block dict to its in-memory representation
+    :param number_of_blocks: <int> Number of blocks
+    :param transactions_per_block: <int> Number of transactions per block
+    :return: <float> Bytes per block
+    """
+
+    tracemalloc.start()
+    chain = [build(block) for block in synthetic_block_dicts(number_of_blocks, transactions_per_block)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert len(chain) == number_of_blocks
+    return current / number_of_blocks
+
+
+def main():
+    number_of_blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    transactions_per_block = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    dict_bytes = measure(lambda block: block, number_of_blocks, transactions_per_block)
+    slotted_bytes = measure(Block.from_dict, number_of_blocks, transactions_per_block)
+
+    print(f'{number_of_blocks} blocks with {transactions_per_block} transactions each')
+    print(f'dict blocks:    {dict_bytes:10.0f} bytes per block')
+    print(f'slotted blocks: {slotted_bytes:10.0f} bytes per block')
+    print(f'reduction:      {100 * (1 - slotted_bytes / dict_bytes):10.1f} %')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,37 @@
+import argparse
+import multiprocessing
+import os
+import socket
 from flask import Flask, jsonify, request
+from flask.json import JSONEncoder
 from urllib.parse import urlparse
 
+import requests
+from werkzeug.serving import make_server
+
+from src import compression
+from src.block import Block, BlockHeader
 from src.blockchain import Blockchain
+from src.bloom_filter import BloomFilter
+from src.cache import ResponseCache
+from src.chain_index import ChainIndex
+from src.chain_store import ChainStore
 from src.proof_of_work import ProofOfWork
+from src.transaction import Transaction
 from src.wallet import Wallet
 
+
+class BlockchainJSONEncoder(JSONEncoder):
+    def default(self, o):
+        # Serialize blocks and transactions to the same JSON as their dict representation
+        if isinstance(o, (Block, BlockHeader, Transaction)):
+            return o.to_dict()
+        return super().default(o)
+
+
 # Instantiate Node
 node = Flask(__name__)
+node.json_encoder = BlockchainJSONEncoder
 
 # Instantiate the blockchain
 blockchain = Blockchain()
@@ -14,29 +39,127 @@ blockchain = Blockchain()
 # Instantiate wallet
 wallet = Wallet()
 
+# Cache for the responses of the read endpoints
+response_cache = ResponseCache()
+
+# In a reader worker process: the shared chain state and the URL of the writer process, see run_workers
+chain_store = None
+writer_url = None
+
+# Endpoints which reader workers answer from the shared chain state, all others are forwarded to the writer
+READ_ENDPOINTS = {
+    'full_chain', 'block_by_hash', 'block_by_height', 'transaction_by_id', 'filtered_transactions',
+    'explorer_address', 'explorer_balance_at_height', 'explorer_balance_history',
+    'node_status', 'headers', 'state', 'cache_stats'
+}
+
+
+def cached_response(key, build_response):
+    """
+    Serve a read endpoint from the response cache. Clients which send the ETag of
+    the current version in If-None-Match get a 304 without a body.
+    The response is built from the index at its published tip, which is also the tip the response is cached for.
+    :param key: <tuple> Everything besides the tip of the chain the response depends on
+    :param build_response: <function> Builds the response from the index and the height of its tip on a cache miss
+    :return: <Response> Response
+    """
+
+    # Compressed and uncompressed bodies are different representations and are cached separately
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    key = key + (encoding,)
+
+    # A block which is appended to the chain but still being indexed is not part of the tip yet
+    index = blockchain.index
+    tip_height, tip_hash = index.tip
+    etag = response_cache.etag(key, tip_hash)
+
+    if etag in request.if_none_match:
+        response_cache.record_not_modified()
+        response = node.response_class(status=304)
+    else:
+        cached = response_cache.get(key, tip_hash)
+        if cached is None:
+            body = jsonify(build_response(index, tip_height)).get_data()
+            if encoding and len(body) >= compression.MIN_SIZE:
+                body = compression.compress(body, encoding)
+            else:
+                encoding = None
+            response_cache.put(key, tip_hash, (body, encoding))
+        else:
+            body, encoding = cached
+        response = node.response_class(body, mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@node.before_request
+def route_to_writer():
+    # Only reader workers have a writer
+    if writer_url is None:
+        return None
+
+    if request.endpoint in READ_ENDPOINTS:
+        chain_store.sync(blockchain)
+        return None
+
+    # Keep the body as it is, the writer already compressed it if the client accepts it
+    headers = {key: value for key, value in request.headers if key.lower() not in ('host', 'content-length')}
+    forwarded = requests.request(request.method, writer_url + request.full_path, headers=headers,
+                                 data=request.get_data(), stream=True)
+
+    response = node.response_class(forwarded.raw.read(decode_content=False), status=forwarded.status_code)
+    for header in ('Content-Type', 'Content-Encoding', 'ETag', 'Vary'):
+        if header in forwarded.headers:
+            response.headers[header] = forwarded.headers[header]
+    return response
+
+
+@node.after_request
+def compress_response(response):
+    # Compress the responses which were not compressed by cached_response, e.g. blocks and headers
+    if response.status_code != 200 or response.mimetype != 'application/json' or \
+            'Content-Encoding' in response.headers or response.direct_passthrough:
+        return response
+
+    body = response.get_data()
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+
+    if encoding and len(body) >= compression.MIN_SIZE:
+        response.set_data(compression.compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+
+    return response
+
 
 @node.route('/wallet/check_balance', defaults={'address': None}, methods=['GET'])
 @node.route('/wallet/check_balance/<address>', methods=['GET'])
 def balance(address):
-    # Update the balance of our wallet
-    wallet.update_balances(blockchain.chain)
+    if address and address not in wallet.address_to_keys:
+        return 'Invalid address', 400
 
-    if address:
-        # Return the balance of a specific address
-        if address in wallet.addresses:
-            response = {
-                'balance': wallet.address_to_balance[address]
+    def build_response(index, tip_height):
+        # Take the balances of our wallet from the index, the transactions of old blocks may be pruned
+        balances = wallet.update_balances(index, tip_height)
+
+        if address:
+            # Return the balance of a specific address
+            return {
+                'balance': balances[address]
             }
-            return jsonify(response), 200
         else:
-            return 'Invalid address', 400
-    else:
-        # Return the total balance of the wallet
-        response = {
-            'balances': wallet.address_to_balance,
-            'total_balance': wallet.total_balance()
-        }
-        return jsonify(response), 200
+            # Return the total balance of the wallet
+            return {
+                'balances': balances,
+                'total_balance': sum(balances.values())
+            }
+
+    # New addresses change the response of the wallet
+    return cached_response(('balance', address, len(wallet.addresses)), build_response)
 
 
 @node.route('/wallet/new', methods=['GET'])
@@ -88,6 +211,7 @@ def new_transaction():
 
     response = {
         'message': "Transaction was added to the mempool and will be included in the next block",
+        'txid': signed_transaction.txid,
         'transaction': signed_transaction
     }
     return jsonify(response), 201
@@ -95,69 +219,307 @@ def new_transaction():
 
 @node.route('/mine', methods=['GET'])
 def mine():
-    # Create a coinbase transaction to collect the block reward (10 coins) the address of the sender has to be "0"
-    coinbase_transaction = {
-        'sender': '0',
-        'recipient': wallet.addresses[0],
-        'amount': 10,
-        'signature': 'coinbase transaction'
+    # Mine like an external miner, the template is stale and a new one is needed if another block arrived meanwhile
+    block = None
+    while block is None:
+        template = blockchain.block_template(wallet.addresses[0])
+
+        # Run the Proof of Work algorithm to find a valid nonce for the block
+        nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+
+        # Create the new block
+        block, _ = blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+
+    response = {
+        'message': "New block added to the chain",
+        'index': block.index,
+        'timestamp': block.timestamp,
+        'nonce': block.nonce,
+        'transactions_hash': block.transactions_hash,
+        'previous_block_hash': block.previous_block_hash,
+        'transactions': block.transactions
     }
+    return jsonify(response), 200
+
+
+@node.route('/mining/template', methods=['GET'])
+def mining_template():
+    # The block reward goes to the address of the miner or to the wallet of this node
+    miner_address = request.args.get('address', wallet.addresses[0])
+
+    template = blockchain.block_template(miner_address)
+
+    return jsonify(template.to_dict()), 200
+
+
+@node.route('/mining/submit', methods=['POST'])
+def mining_submit():
+    values = request.get_json()
 
-    # Include all transactions of the mempool in the next block including the coinbase transaction
-    transactions_of_block = blockchain.mempool.current_transactions
-    transactions_of_block.append(coinbase_transaction)
+    # Check if the data of the POST request is valid
+    required = ['transactions_hash', 'previous_block_hash', 'nonce']
+    if not values or not all(k in values for k in required):
+        return 'Missing values!', 400
+    # JSON true and false are bools, which are ints in Python, so the type of the nonce is checked exactly
+    if not isinstance(values['transactions_hash'], str) or not isinstance(values['previous_block_hash'], str) or \
+            type(values['nonce']) is not int:
+        return 'Invalid values!', 400
 
-    # Run the Proof of Work algorithm to find a valid nonce for the block
-    previous_block = blockchain.last_block
-    previous_block_hash = blockchain.hash(previous_block)
-    transactions_hash = blockchain.mempool.hash(transactions_of_block)
-    nonce = ProofOfWork.proof_of_work(transactions_hash, previous_block_hash)
+    block, error = blockchain.submit_block(values['transactions_hash'], values['previous_block_hash'],
+                                           values['nonce'])
 
-    # Create the new block
-    block = blockchain.create_block(nonce, previous_block_hash, transactions_of_block)
+    if block is None:
+        return error, 400
 
     response = {
         'message': "New block added to the chain",
-        'index': block['index'],
-        'timestamp': block['timestamp'],
-        'nonce': block['nonce'],
-        'transactions_hash': block['transactions_hash'],
-        'previous_block_hash': block['previous_block_hash'],
-        'transactions': block['transactions']
+        'index': block.index,
+        'hash': block.hash
     }
-    return jsonify(response), 200
+    return jsonify(response), 201
 
 
 @node.route('/explorer/<address>', methods=['GET'])
 def explorer_address(address):
-    last_block_index = len(blockchain.chain)
+    # Pagination of the transaction history, the cursor is returned as next_cursor by the previous page
+    direction = request.args.get('direction', 'all')
+    cursor = request.args.get('cursor', 0, type=int)
+    limit = request.args.get('limit', 100, type=int)
+
+    if direction not in ChainIndex.DIRECTIONS or cursor < 0 or not 0 < limit <= 1000:
+        return 'Invalid pagination parameters!', 400
+
+    def build_response(index, tip_height):
+        transactions, next_cursor = index.address_history(address, direction, cursor, limit, tip_height)
+
+        send = [transaction for _, _, transaction in transactions if transaction.sender == address]
+        received = [transaction for _, _, transaction in transactions if transaction.sender != address]
+
+        return {
+            'balance': index.address_balance_at_height(address, tip_height),
+            'number_of_transactions': index.number_of_transactions(address, direction, tip_height),
+            'send_transactions': send,
+            'received_transactions': received,
+            'next_cursor': next_cursor
+        }
+
+    return cached_response(('explorer', address, direction, cursor, limit), build_response)
+
 
-    balance_of_address = blockchain.address_balance_at_block_index(address, blockchain.chain, last_block_index)
-    number, send, received = blockchain.address_transactions_at_block_index(address, blockchain.chain, last_block_index)
+@node.route('/explorer/<address>/balance', methods=['GET'])
+def explorer_balance_at_height(address):
+    # Balance after the block at the height, the tip by default
+    height = request.args.get('height', type=int)
 
+    if height is not None and not 0 <= height <= blockchain.index.tip[0]:
+        return 'Block not found!', 404
+
+    # Only the balance at the pruned height is kept for the pruned blocks
+    if height is not None and height < blockchain.index.pruned_height:
+        return 'Balance at this height was pruned!', 404
+
+    def build_response(index, tip_height):
+        at_height = tip_height if height is None else height
+
+        return {
+            'address': address,
+            'height': at_height,
+            'balance': index.address_balance_at_height(address, at_height)
+        }
+
+    return cached_response(('balance_at_height', address, height), build_response)
+
+
+@node.route('/explorer/<address>/balance_history', methods=['GET'])
+def explorer_balance_history(address):
+    # Range of heights, the next page starts at next_height of the previous page
+    start = request.args.get('start', 0, type=int)
+    end = request.args.get('end', type=int)
+    limit = request.args.get('limit', 1000, type=int)
+
+    if start < 0 or (end is not None and end < start) or not 0 < limit <= 10000:
+        return 'Invalid range!', 400
+
+    def build_response(index, tip_height):
+        # The history of pruned blocks is not kept, it starts after the pruned height
+        from_height = max(start, index.pruned_height + 1)
+        end_height = tip_height if end is None else min(end, tip_height)
+        opening_balance, changes, next_height = index.balance_history(address, from_height, end_height, limit)
+
+        return {
+            'address': address,
+            'start': from_height,
+            'opening_balance': opening_balance,
+            'history': [{'height': height, 'balance': balance} for height, balance in changes],
+            'next_height': next_height
+        }
+
+    return cached_response(('balance_history', address, start, end, limit), build_response)
+
+
+@node.route('/mempool', methods=['GET'])
+def mempool():
+    def build_response(index, tip_height):
+        transactions = blockchain.mempool.snapshot()
+
+        return {
+            'mempool': transactions,
+            'size': len(transactions)
+        }
+
+    return cached_response(('mempool', blockchain.mempool.version), build_response)
+
+
+@node.route('/chain', methods=['GET'])
+def full_chain():
+    def build_response(index, tip_height):
+        chain = index.snapshot(tip_height)
+
+        return {
+            'chain': chain,
+            'length': len(chain)
+        }
+
+    return cached_response(('chain',), build_response)
+
+
+@node.route('/block/<block_hash>', methods=['GET'])
+def block_by_hash(block_hash):
+    result = blockchain.index.block_by_hash(block_hash)
+
+    if result is None:
+        return 'Block not found!', 404
+
+    height, block = result
     response = {
-        'balance': balance_of_address,
-        'number_of_transactions': number,
-        'send_transactions': send,
-        'received_transactions': received
+        'height': height,
+        'hash': block.hash,
+        'block': block
     }
     return jsonify(response), 200
 
 
-@node.route('/mempool', methods=['GET'])
-def mempool():
+@node.route('/block/height/<int:height>', methods=['GET'])
+def block_by_height(height):
+    block = blockchain.index.block_by_height(height)
+
+    if block is None:
+        return 'Block not found!', 404
+
     response = {
-        'mempool': blockchain.mempool.current_transactions,
-        'size': len(blockchain.mempool.current_transactions)
+        'height': height,
+        'hash': block.hash,
+        'block': block
     }
     return jsonify(response), 200
 
 
-@node.route('/chain', methods=['GET'])
-def full_chain():
+@node.route('/tx/<txid>', methods=['GET'])
+def transaction_by_id(txid):
+    result = blockchain.index.transactions_by_id(txid)
+
+    if not result:
+        return 'Transaction not found!', 404
+
+    # Identical transactions have the same id, all of their locations are returned in chain order
+    response = {
+        'txid': txid,
+        'transactions': [
+            {'block_hash': block.hash, 'height': height, 'position': position, 'transaction': transaction}
+            for height, block, position, transaction in result
+        ]
+    }
+    return jsonify(response), 200
+
+
+@node.route('/filter/transactions', methods=['POST'])
+def filtered_transactions():
+    values = request.get_json()
+
+    # Light clients send a bloom filter of their addresses instead of the addresses themselves
+    if not values or 'filter' not in values:
+        return 'Missing values!', 400
+
+    try:
+        bloom_filter = BloomFilter.from_dict(values['filter'])
+    except (KeyError, TypeError, ValueError):
+        return 'Invalid filter!', 400
+
+    start_height = values.get('start_height', 0)
+    max_blocks = values.get('max_blocks', 1000)
+    if not isinstance(start_height, int) or not isinstance(max_blocks, int) or \
+            start_height < 0 or not 0 < max_blocks <= 10000:
+        return 'Invalid range!', 400
+
+    index = blockchain.index
+    transactions, next_height = index.matching_transactions(bloom_filter, start_height, max_blocks)
+
+    response = {
+        'transactions': [
+            {'height': height, 'position': position, 'txid': transaction.txid, 'transaction': transaction}
+            for height, position, transaction in transactions
+        ],
+        'next_height': next_height,
+        'length': len(index.chain),
+        'pruned_height': blockchain.pruned_height
+    }
+    return jsonify(response), 200
+
+
+@node.route('/node/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(response_cache.stats()), 200
+
+
+@node.route('/node/status', methods=['GET'])
+def node_status():
+    last_block = blockchain.last_block
+
+    response = {
+        'height': last_block.index - 1,
+        'tip_hash': last_block.hash,
+        'pruned_height': blockchain.pruned_height
+    }
+    return jsonify(response), 200
+
+
+@node.route('/headers', methods=['GET'])
+def headers():
+    start = request.args.get('start', 0, type=int)
+    limit = request.args.get('limit', 1000, type=int)
+
+    if start < 0 or not 0 < limit <= 10000:
+        return 'Invalid range!', 400
+
+    # Headers are kept for every block, also in pruned mode
+    chain = blockchain.chain
+    response = {
+        'headers': [block.header() for block in chain[start:start + limit]],
+        'length': len(chain)
+    }
+    return jsonify(response), 200
+
+
+@node.route('/state', methods=['GET'])
+def state():
+    index = blockchain.index
+    tip_height, tip_hash = index.tip
+
+    # The balances derived from all transactions, also from pruned ones
+    response = {
+        'height': tip_height,
+        'tip_hash': tip_hash,
+        'pruned_height': blockchain.pruned_height,
+        'balances': dict(index.address_balances)
+    }
+    return jsonify(response), 200
+
+
+@node.route('/node/peers', methods=['GET'])
+def peers():
     response = {
-        'chain': blockchain.chain,
-        'length': len(blockchain.chain)
+        'peers': blockchain.network.stats(),
+        'max_active_peers': blockchain.network.max_active_peers
     }
     return jsonify(response), 200
 
@@ -195,20 +557,119 @@ def register_nodes():
 
 @node.route('/node/consensus', methods=['GET'])
 def consensus():
-    if blockchain.reach_consensus():
+    replaced = blockchain.reach_consensus()
+    chain = blockchain.snapshot()
+
+    if replaced:
         response = {
-            'message': f"Chain was replaced by a longer chain with {len(blockchain.chain)} blocks",
-            'new_chain': blockchain.chain
+            'message': f"Chain was replaced by a longer chain with {len(chain)} blocks",
+            'new_chain': chain
         }
     else:
         response = {
-            'message': f"Chain is the currently the longest chain with {len(blockchain.chain)} blocks",
-            'chain': blockchain.chain
+            'message': f"Chain is the currently the longest chain with {len(chain)} blocks",
+            'chain': chain
         }
 
     return jsonify(response), 200
 
 
+def serve_reader(host, port, fd, data_dir, url, prune_depth):
+    """
+    Serve the read endpoints in a worker process from the chain state in the data directory.
+    :param host: <str> Host the listening socket is bound to
+    :param port: <int> Port the listening socket is bound to
+    :param fd: <int> File descriptor of the listening socket shared by all workers
+    :param data_dir: <str> Data directory of the node
+    :param url: <str> URL of the writer process
+    :param prune_depth: <int> Prune depth of the writer or None
+    :return: None
+    """
+
+    global blockchain, chain_store, writer_url, response_cache
+
+    # The chain is loaded from the store, the state inherited from the writer is not used
+    blockchain = Blockchain(prune_depth=prune_depth)
+    chain_store = ChainStore(data_dir)
+    chain_store.sync(blockchain)
+    response_cache = ResponseCache()
+    writer_url = url
+
+    make_server(host, port, node, threaded=True, fd=fd).serve_forever()
+
+
+def run_workers(host, port, data_dir, workers, prune_depth=None):
+    """
+    Run the node as one writer process and several reader worker processes.
+    The workers share the listening socket, answer the read endpoints from the chain state
+    in the data directory and forward everything else, e.g. transactions, mining and consensus,
+    to the writer, which is the only process that changes the chain.
+    :param host: <str> Host to listen on
+    :param port: <int> Port to listen on
+    :param data_dir: <str> Data directory of the node
+    :param workers: <int> Number of reader worker processes
+    :param prune_depth: (Optional) <int> Prune depth of the writer, the workers prune their chains alike
+    :return: None
+    """
+
+    listener = socket.create_server((host, port), backlog=128)
+    writer = make_server('127.0.0.1', 0, node, threaded=True)
+    url = f'http://127.0.0.1:{writer.server_port}'
+
+    # Fork the workers before the writer starts serving
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=serve_reader,
+                                 args=(host, port, listener.fileno(), data_dir, url, prune_depth),
+                                 daemon=True) for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    try:
+        writer.serve_forever()
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description='Run a blockchain node.')
+    parser.add_argument('--host', default='0.0.0.0', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=5000, help='Port to listen on')
+    parser.add_argument('--data-dir', help='Directory of the persistent chain state, kept in memory if omitted')
+    parser.add_argument('--peers', nargs='*', default=[], help='Nodes to connect to, e.g. http://127.0.0.1:5001')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of reader worker processes, requires --data-dir, 0 serves everything in one process')
+    parser.add_argument('--prune-depth', type=int,
+                        help='Drop the transactions of blocks more than this many blocks below the last block, '
+                             'all are kept if omitted')
+    args = parser.parse_args(argv)
+
+    if args.workers < 0:
+        parser.error('--workers must not be negative')
+    if args.workers and not args.data_dir:
+        parser.error('--workers requires --data-dir')
+    if args.prune_depth is not None and args.prune_depth < 0:
+        parser.error('--prune-depth must not be negative')
+
+    global blockchain, wallet
+    if args.data_dir:
+        blockchain = Blockchain(prune_depth=args.prune_depth, store=ChainStore(args.data_dir))
+        # Keep the keys of the coins mined by this node across restarts
+        wallet = Wallet(os.path.join(args.data_dir, 'wallet.json'))
+    elif args.prune_depth is not None:
+        blockchain = Blockchain(prune_depth=args.prune_depth)
+
+    for peer in args.peers:
+        blockchain.network.register_node(peer)
+    if args.peers:
+        blockchain.reach_consensus()
+
+    if args.workers:
+        run_workers(args.host, args.port, args.data_dir, args.workers, args.prune_depth)
+    else:
+        # Every request is handled in its own thread, see Blockchain.lock for the concurrency model
+        node.run(host=args.host, port=args.port, threaded=True)
+
+
 if __name__ == '__main__':
-    port = int(input("Port: "))
-    node.run(host='0.0.0.0', port=port)
+    run()
@@ -0,0 +1,86 @@
+"""
+Standalone miner which hashes independently of the node.
+It requests block templates from a node, searches for a nonce in several processes
+and submits the solution. Start as many miners against a node as you like.
+
+Usage: python miner.py --node http://127.0.0.1:5000 [--address ADDRESS] [--processes 4] [--blocks 10]
+"""
+import argparse
+from multiprocessing import Pool
+
+import requests
+
+from src.proof_of_work import ProofOfWork
+
+# Nonces tried by each process before the miner checks whether the template is still current
+BATCH_SIZE = 50000
+
+
+def search(job):
+    """
+    Search a slice of the nonce space, process i of n tries the nonces i, i + n, i + 2n, ...
+    :param job: <tuple> Transactions hash, previous block hash, first nonce, step
+    :return: <int> Valid nonce or None
+    """
+
+    transactions_hash, previous_block_hash, start, step = job
+    return ProofOfWork.proof_of_work(transactions_hash, previous_block_hash, start, step, BATCH_SIZE)
+
+
+def mine_block(node, address, pool, processes):
+    """
+    Mine one block on top of the current last block of the node.
+    :param node: <str> URL of the node
+    :param address: <str> Address which receives the block reward or None for the wallet of the node
+    :param pool: <Pool> Worker processes
+    :param processes: <int> Number of worker processes
+    :return: <dict> Response of the node to the submission or None if the template went stale
+    """
+
+    params = {'address': address} if address else {}
+    template = requests.get(f'{node}/mining/template', params=params).json()
+    transactions_hash = template['transactions_hash']
+    previous_block_hash = template['previous_block_hash']
+
+    offset = 0
+    while True:
+        jobs = [(transactions_hash, previous_block_hash, offset + i, processes) for i in range(processes)]
+        nonces = [nonce for nonce in pool.map(search, jobs) if nonce is not None]
+
+        if nonces:
+            response = requests.post(f'{node}/mining/submit', json={
+                'transactions_hash': transactions_hash,
+                'previous_block_hash': previous_block_hash,
+                'nonce': min(nonces)
+            })
+            return response.json() if response.status_code == 201 else None
+
+        # Give up on the template if another block was added in the meantime
+        status = requests.get(f'{node}/node/status').json()
+        if status['tip_hash'] != previous_block_hash:
+            return None
+
+        offset += processes * BATCH_SIZE
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Standalone miner')
+    parser.add_argument('--node', default='http://127.0.0.1:5000', help='URL of the node')
+    parser.add_argument('--address', help='address which receives the block rewards')
+    parser.add_argument('--processes', type=int, default=1, help='number of hashing processes')
+    parser.add_argument('--blocks', type=int, default=0, help='stop after this many blocks, 0 to mine forever')
+    args = parser.parse_args()
+
+    mined = 0
+    with Pool(args.processes) as pool:
+        while args.blocks == 0 or mined < args.blocks:
+            result = mine_block(args.node.rstrip('/'), args.address, pool, args.processes)
+            if result is None:
+                print('Block template went stale, requesting a new one')
+            else:
+                mined += 1
+                print(f"Mined block {result['index']} {result['hash']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import hashlib
+import json
+
+from src.transaction import Transaction
+
+
+class Block:
+    """
+    A block of the chain.
+    Uses __slots__ instead of a dict per block to keep large chains small in memory.
+    Blocks are never modified once created, which allows caching their hash.
+    """
+
+    __slots__ = ('index', 'timestamp', 'nonce', 'transactions_hash', 'previous_block_hash', 'transactions',
+                 '_hash')
+
+    FIELDS = ('index', 'timestamp', 'nonce', 'transactions_hash', 'previous_block_hash', 'transactions')
+
+    def __init__(self, index, timestamp, nonce, transactions_hash, previous_block_hash, transactions):
+        self.index = index
+        self.timestamp = timestamp
+        self.nonce = nonce
+        self.transactions_hash = transactions_hash
+        self.previous_block_hash = previous_block_hash
+        self.transactions = transactions
+        self._hash = None
+
+    @classmethod
+    def from_dict(cls, block):
+        """
+        Create a block from its JSON representation.
+        Pruned blocks are represented by their header, which has a hash instead of transactions.
+        :param block: <dict> Block
+        :return: <Block> or <BlockHeader> Block
+        """
+
+        if 'transactions' not in block and 'hash' in block:
+            return BlockHeader.from_dict(block)
+
+        transactions = block['transactions']
+        if transactions is not None:
+            transactions = [Transaction.coerce(transaction) for transaction in transactions]
+
+        return cls(block['index'], block['timestamp'], block['nonce'], block['transactions_hash'],
+                   block['previous_block_hash'], transactions)
+
+    @classmethod
+    def coerce(cls, block):
+        """
+        Return the block as a Block object, converting it if it is a dict. Headers of pruned blocks are kept.
+        :param block: <Block>, <BlockHeader> or <dict> Block
+        :return: <Block> or <BlockHeader> Block
+        """
+
+        if isinstance(block, (cls, BlockHeader)):
+            return block
+        return cls.from_dict(block)
+
+    def to_dict(self):
+        """
+        Return the JSON representation of the block.
+        :return: <dict> Block
+        """
+
+        transactions = self.transactions
+        if transactions is not None:
+            transactions = [transaction.to_dict() for transaction in transactions]
+
+        return {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'nonce': self.nonce,
+            'transactions_hash': self.transactions_hash,
+            'previous_block_hash': self.previous_block_hash,
+            'transactions': transactions
+        }
+
+    @property
+    def hash(self):
+        """
+        SHA-256 hash of the block, calculated once and cached.
+        :return: <str> Hash of the block
+        """
+
+        if self._hash is None:
+            # Order the block to avoid inconsistent hashes
+            block_encoded = json.dumps(self.to_dict(), sort_keys=True).encode()
+            self._hash = hashlib.sha256(block_encoded).hexdigest()
+        return self._hash
+
+    def header(self):
+        """
+        Return the header of the block without the transactions.
+        :return: <BlockHeader> Header of the block
+        """
+
+        return BlockHeader(self.index, self.timestamp, self.nonce, self.transactions_hash, self.previous_block_hash,
+                           self.hash)
+
+    def __getitem__(self, key):
+        # Allow dict style access for code written against the JSON representation
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f'Block(index={self.index!r}, transactions_hash={self.transactions_hash!r})'
+
+
+class BlockHeader:
+    """
+    A block whose transactions were pruned. The hash can no longer be calculated
+    without the transactions, so it is stored. The transactions are still committed
+    to by the transactions hash.
+    """
+
+    __slots__ = ('index', 'timestamp', 'nonce', 'transactions_hash', 'previous_block_hash', 'hash')
+
+    # Pruned blocks have no transactions, code iterating over blocks skips them like the genesis block
+    transactions = None
+
+    def __init__(self, index, timestamp, nonce, transactions_hash, previous_block_hash, hash):
+        self.index = index
+        self.timestamp = timestamp
+        self.nonce = nonce
+        self.transactions_hash = transactions_hash
+        self.previous_block_hash = previous_block_hash
+        self.hash = hash
+
+    @classmethod
+    def from_dict(cls, header):
+        """
+        Create a header from its JSON representation.
+        :param header: <dict> Header
+        :return: <BlockHeader> Header
+        """
+
+        return cls(header['index'], header['timestamp'], header['nonce'], header['transactions_hash'],
+                   header['previous_block_hash'], header['hash'])
+
+    def header(self):
+        return self
+
+    def to_dict(self):
+        """
+        Return the JSON representation of the header.
+        :return: <dict> Header
+        """
+
+        return {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'nonce': self.nonce,
+            'transactions_hash': self.transactions_hash,
+            'previous_block_hash': self.previous_block_hash,
+            'hash': self.hash
+        }
+
+    def __repr__(self):
+        return f'BlockHeader(index={self.index!r}, hash={self.hash!r})'
@@ -0,0 +1,128 @@
+import hashlib
+import json
+
+from src.mempool import Mempool
+from src.proof_of_work import ProofOfWork
+
+
+class BlockTemplate:
+    """
+    Everything a miner needs to search for a nonce of the next block:
+    the transactions of the block and the hash of the block it builds on.
+    """
+
+    __slots__ = ('index', 'previous_block_hash', 'transactions', 'transactions_hash')
+
+    def __init__(self, index, previous_block_hash, transactions, transactions_hash=None):
+        self.index = index
+        self.previous_block_hash = previous_block_hash
+        self.transactions = transactions
+        self.transactions_hash = transactions_hash or Mempool.hash(transactions)
+
+    def to_dict(self):
+        return {
+            'index': self.index,
+            'previous_block_hash': self.previous_block_hash,
+            'transactions_hash': self.transactions_hash,
+            'transactions': [transaction.to_dict() for transaction in self.transactions],
+            'difficulty': ProofOfWork.DIFFICULTY,
+            'target': ProofOfWork.TARGET
+        }
+
+
+class BlockTemplateBuilder:
+    """
+    Selects the transactions of the next block from the mempool in priority order until
+    the block is full. Transactions which do not fit stay in the mempool for later blocks.
+
+    The transactions hash is the SHA-256 of the JSON list of the transactions (see Mempool.hash).
+    The builder keeps the hash state of the selected transactions, so while new transactions are
+    only appended to the selection, the next template only hashes the new transactions and the coinbase.
+    """
+
+    # Sort keys of the supported priorities, None keeps the arrival order of the mempool.
+    # Transactions carry no fee yet, a fee priority can be added here once they do.
+    PRIORITIES = {
+        'arrival': None,
+        'amount': lambda transaction: -transaction.amount
+    }
+
+    def __init__(self, max_transactions=1000, max_bytes=1000000, priority='arrival'):
+        """
+        :param max_transactions: <int> Maximum number of transactions of a block including the coinbase transaction
+        :param max_bytes: <int> Maximum size of the JSON list of the transactions of a block
+        :param priority: <str> Order in which transactions are selected, a key of PRIORITIES
+        :raises ValueError: If the priority is unknown or the limits leave no room for the coinbase transaction
+        """
+
+        if priority not in self.PRIORITIES:
+            raise ValueError(f'Unknown priority {priority}')
+        if max_transactions < 1:
+            raise ValueError('A block needs room for the coinbase transaction')
+
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        self.priority = priority
+
+        self.reset()
+
+    def reset(self):
+        # Selected mempool transactions and the hash state and size of '[' followed by their JSON
+        self.selection = []
+        self.hasher = hashlib.sha256(b'[')
+        self.size = 1
+
+    @staticmethod
+    def encode(transaction):
+        # Same encoding as an element of the list hashed by Mempool.hash
+        return json.dumps(transaction.to_dict(), sort_keys=True).encode()
+
+    def select(self, transactions, reserved_bytes):
+        """
+        Extend the selection with transactions in priority order until the block is full.
+        :param transactions: <list> Transactions of the mempool in arrival order
+        :param reserved_bytes: <int> Bytes needed to append the coinbase transaction and close the list
+        :return: None
+        """
+
+        key = self.PRIORITIES[self.priority]
+        candidates = sorted(transactions, key=key) if key else transactions
+
+        # The hash state can only be reused if the selection is still the start of the candidates,
+        # e.g. not after a block removed transactions from the mempool, and still leaves room for the coinbase
+        if len(candidates) < len(self.selection) or self.size + reserved_bytes > self.max_bytes or \
+                any(selected is not candidate for selected, candidate in zip(self.selection, candidates)):
+            self.reset()
+
+        for transaction in candidates[len(self.selection):]:
+            if len(self.selection) + 1 >= self.max_transactions:
+                break
+
+            encoded = self.encode(transaction)
+            separator = b', ' if self.selection else b''
+            if self.size + len(separator) + len(encoded) + reserved_bytes > self.max_bytes:
+                break
+
+            self.hasher.update(separator + encoded)
+            self.size += len(separator) + len(encoded)
+            self.selection.append(transaction)
+
+    def build(self, index, previous_block_hash, transactions, coinbase_transaction):
+        """
+        Build the template of the next block.
+        :param index: <int> Index of the next block
+        :param previous_block_hash: <str> Hash of the last block
+        :param transactions: <list> Transactions of the mempool in arrival order
+        :param coinbase_transaction: <Transaction> Coinbase transaction, appended as the last transaction
+        :return: <BlockTemplate> Block template
+        """
+
+        encoded_coinbase = self.encode(coinbase_transaction)
+        # Separator, coinbase transaction and the closing bracket
+        self.select(transactions, len(b', ') + len(encoded_coinbase) + 1)
+
+        hasher = self.hasher.copy()
+        hasher.update((b', ' if self.selection else b'') + encoded_coinbase + b']')
+
+        return BlockTemplate(index, previous_block_hash, self.selection + [coinbase_transaction],
+                             hasher.hexdigest())
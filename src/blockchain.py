@@ -1,29 +1,71 @@
 from bitcoin import *
 import hashlib
 import json
+import socket
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from time import time
 import requests
-
+import urllib3
+
+from src import compression
+from src.block import Block
+from src.block_template import BlockTemplateBuilder
+from src.chain_index import ChainIndex
+from src.chain_stream import iter_chain_blocks
+from src.chain_validator import ChainValidator
+from src.transaction import Transaction
 from src.proof_of_work import ProofOfWork
 from src.mempool import Mempool
 from src.network import Network
 
 
 class Blockchain:
-    def __init__(self):
+    # Number of block templates handed out to miners which are remembered for submissions
+    MAX_BLOCK_TEMPLATES = 64
+
+    def __init__(self, prune_depth=None, max_block_transactions=1000, max_block_bytes=1000000,
+                 block_priority='arrival', store=None):
         self.chain = []
 
+        # Persistent chain state of the writer process of a node, None keeps the chain in memory only
+        self.store = store
+
+        # Transactions of blocks more than prune_depth blocks below the last block are dropped, None keeps everything
+        self.prune_depth = prune_depth
+        # Height of the last block whose transactions were dropped, -1 if nothing is pruned
+        self.pruned_height = -1
+
+        # Lookup indexes over the chain, replaced together with the chain
+        self.index = ChainIndex(self.chain)
+
+        # Writers (block creation, chain replacement and mempool admission) are serialized by this lock.
+        # Readers never take it, they work on snapshots of the chain instead.
+        self.lock = threading.RLock()
+
         # Instantiate mempool
         self.mempool = Mempool()
 
         # Instantiate the network of nodes which are connected to his node
         self.network = Network()
 
-        # Create the genesis block
-        self.create_block(
-            nonce=0,
-            previous_block_hash='86a4be451d0e4ae83bcd72e1eb5308b19a4b270f95c25d752927341f7632a1cc'
-        )
+        # Block templates handed out to miners, transactions hash -> template
+        self.block_templates = OrderedDict()
+        # Selects the transactions of new blocks from the mempool within the block limits
+        self.template_builder = BlockTemplateBuilder(max_block_transactions, max_block_bytes, block_priority)
+
+        stored_chain, stored_state = store.load() if store is not None else ([], None)
+
+        if stored_chain:
+            # Continue with the stored chain, it was already validated when its blocks were added
+            self.replace_chain(stored_chain, stored_state, persist=False)
+        else:
+            # Create the genesis block
+            self.create_block(
+                nonce=0,
+                previous_block_hash='86a4be451d0e4ae83bcd72e1eb5308b19a4b270f95c25d752927341f7632a1cc'
+            )
 
     def create_block(self, nonce, previous_block_hash=None, transactions_of_block=None):
         """
@@ -31,42 +73,215 @@ class Blockchain:
         :param nonce: <int> The nonce calculated by the Proof of Work algorithm
         :param previous_block_hash: (Optional) <str> Hash of previous block
         :param transactions_of_block: <list> Transactions included in the block
-        :return: block: <dict> Created and appended block
+        :return: block: <Block> Created and appended block
         """
 
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'nonce': nonce,
-            'transactions_hash': self.mempool.hash(transactions_of_block),
-            'previous_block_hash': previous_block_hash or self.hash(self.chain[-1]),
-            'transactions': transactions_of_block
-        }
+        if transactions_of_block is not None:
+            transactions_of_block = [Transaction.coerce(transaction) for transaction in transactions_of_block]
 
-        # Reset the mempool
-        self.mempool.current_transactions = []
+        with self.lock:
+            block = Block(
+                index=len(self.chain) + 1,
+                timestamp=time(),
+                nonce=nonce,
+                transactions_hash=self.mempool.hash(transactions_of_block),
+                previous_block_hash=previous_block_hash or self.hash(self.chain[-1]),
+                transactions=transactions_of_block
+            )
 
-        # Add the new block to the end of the chain
-        self.chain.append(block)
+            self.add_block(block)
 
         return block
 
+    def add_block(self, block):
+        """
+        Append a block to the chain, e.g. a block created by this node or read from the store by a reader process.
+        :param block: <Block> Block which extends the last block
+        :return: None
+        """
+
+        with self.lock:
+            # Remove the included transactions from the mempool
+            self.mempool.remove_transactions(block.transactions)
+
+            # Add the new block to the end of the chain, then make it visible in the indexes
+            self.chain.append(block)
+            self.index.add_block(block, len(self.chain) - 1)
+
+            # Persist the block before its transactions can be pruned
+            if self.store is not None:
+                self.store.append(block)
+
+            self.prune()
+
+    def block_template(self, miner_address):
+        """
+        Create a template for the next block from the transactions in the mempool and remember it
+        so that a miner can submit a nonce for it later. Transactions which do not fit into the
+        block stay in the mempool.
+        :param miner_address: <str> Address which receives the block reward
+        :return: <BlockTemplate> Block template
+        """
+
+        # Create a coinbase transaction to collect the block reward (10 coins) the address of the sender has to be "0"
+        coinbase_transaction = Transaction(
+            sender='0',
+            recipient=miner_address,
+            amount=10,
+            signature='coinbase transaction'
+        )
+
+        with self.lock:
+            # Fill the next block with transactions of the mempool by priority, followed by the coinbase transaction
+            template = self.template_builder.build(len(self.chain) + 1, self.last_block.hash,
+                                                   self.mempool.current_transactions, coinbase_transaction)
+
+            self.block_templates[template.transactions_hash] = template
+            if len(self.block_templates) > self.MAX_BLOCK_TEMPLATES:
+                self.block_templates.popitem(last=False)
+
+        return template
+
+    def submit_block(self, transactions_hash, previous_block_hash, nonce):
+        """
+        Append the block of a previously created template if the nonce is a valid proof.
+        The transactions of a template were validated against the chain when they entered the mempool.
+        Replacing the chain revalidates the mempool and drops the templates, so the transactions of a
+        template are still valid as long as it builds on the last block.
+        :param transactions_hash: <str> Hash of the transactions of the template
+        :param previous_block_hash: <str> Hash of the block the template builds on
+        :param nonce: <int> Nonce found by the miner
+        :return: block: <Block> Appended block or None,
+        error: <str> Reason why the block was rejected or None
+        """
+
+        with self.lock:
+            template = self.block_templates.get(transactions_hash)
+
+            if template is None or template.previous_block_hash != previous_block_hash:
+                return None, 'Unknown block template!'
+
+            if previous_block_hash != self.last_block.hash:
+                return None, 'Block template is stale!'
+
+            if not ProofOfWork.valid_proof(transactions_hash, previous_block_hash, nonce):
+                return None, 'Invalid proof of work!'
+
+            # Templates building on the old last block are stale from now on
+            self.block_templates.clear()
+
+            return self.create_block(nonce, previous_block_hash, template.transactions), None
+
+    def replace_chain(self, chain, state=None, persist=True):
+        """
+        Replace the chain and rebuild the lookup indexes. The caller must hold the lock.
+        :param chain: <list> The new blockchain
+        :param state: (Optional) <dict> State of the pruned blocks if the chain starts with headers,
+        see ChainIndex.pruned_state
+        :param persist: <bool> False if the chain was read from the store
+        :return: None
+        """
+
+        replaced_index = self.index
+        self.index = ChainIndex(chain, state)
+        self.chain = chain
+        self.pruned_height = self.index.pruned_height
+
+        if self.store is not None and persist:
+            self.store.write(chain, state)
+
+        self.revalidate_mempool(replaced_index)
+        self.prune()
+
+    def revalidate_mempool(self, replaced_index):
+        """
+        Drop the transactions of the mempool which are included in the new blocks of a replaced chain
+        or which are no longer covered by the balances of the new chain. The templates handed out to
+        miners build on the replaced chain and are dropped as well. The caller must hold the lock.
+        :param replaced_index: <ChainIndex> Index of the replaced chain
+        :return: None
+        """
+
+        self.block_templates.clear()
+
+        # Blocks after the fork point are new, their transactions left the mempool on the node which mined them
+        included = set()
+        for block in reversed(self.chain):
+            if block.hash in replaced_index.block_heights:
+                break
+            included.update(transaction.txid for transaction in block.transactions or [])
+
+        # The mempool holds one transaction per sender, so each is checked against the balances on its own
+        dropped = [transaction for transaction in self.mempool.current_transactions
+                   if transaction.txid in included or
+                   not self.valid_transaction(transaction, None, None, self.index.address_balances)]
+        if dropped:
+            self.mempool.remove_transactions(dropped)
+
+    def prune(self):
+        """
+        Drop the transactions of blocks which are more than prune_depth blocks below the last block.
+        The headers of the blocks are kept, so the chain stays linked, and the balances derived from the
+        transactions are kept in the index. The caller must hold the lock.
+        :return: None
+        """
+
+        if self.prune_depth is None:
+            return
+
+        prune_height = len(self.chain) - 1 - self.prune_depth
+        if self.pruned_height >= prune_height:
+            return
+
+        # Blocks are never modified in place, the headers go into a copy of the chain which replaces it
+        chain = list(self.chain)
+
+        while self.pruned_height < prune_height:
+            height = self.pruned_height + 1
+            block = chain[height]
+
+            # Remove the transactions from the index before they disappear from the chain
+            self.index.prune_block(block, height)
+            chain[height] = block.header()
+
+            self.pruned_height = height
+
+        self.chain = chain
+        self.index.chain = chain
+
+        # Drop the pruned transactions from the store as well, rewriting it is only worth it now and then
+        if self.store is not None and self.pruned_height - self.store.compacted_height >= self.store.COMPACT_INTERVAL:
+            self.store.write(self.chain, self.index.pruned_state())
+
     @staticmethod
     def hash(block):
         """
         Calculate a SHA-256 hash of a block.
-        :param block: <dict> Block
+        :param block: <Block> or <dict> Block
         :return: <str> Hash of the block
         """
 
+        if isinstance(block, Block):
+            return block.hash
+
         # Order the block to avoid inconsistent hashes
-        block_encoded = json.dumps(block, sort_keys=True).encode()
+        block_encoded = json.dumps(block, sort_keys=True, default=lambda o: o.to_dict()).encode()
         return hashlib.sha256(block_encoded).hexdigest()
 
     @property
     def last_block(self):
         return self.chain[-1]
 
+    def snapshot(self):
+        """
+        Return an immutable view of the chain without waiting for writers.
+        Blocks are never modified once appended and the chain list is only appended to
+        or replaced while holding the lock, also when blocks are pruned, so copying it is safe.
+        :return: <tuple> Blocks of the chain
+        """
+
+        return tuple(self.chain)
+
     def reach_consensus(self):
         """
         Algorithm used to reach consensus in the network.
@@ -75,85 +290,186 @@ class Blockchain:
         :return: <bool> True if chain was replaced, False if not
         """
 
-        neighbour_nodes = self.network.nodes
+        neighbour_nodes = self.network.active_peers()
+
+        # Ask the peers for their height in parallel, so a slow peer costs at most the timeout
+        if neighbour_nodes:
+            with ThreadPoolExecutor(max_workers=len(neighbour_nodes)) as executor:
+                list(executor.map(self.probe_node, neighbour_nodes))
 
         longest_chain_length = len(self.chain)
         longer_chain = None
 
-        # Query all the nodes in the network and request their chain
-        for node in neighbour_nodes:
-            response = requests.get(f'http://{node}/chain')
+        # Download the chains of the highest and fastest peers first
+        for node, height in self.network.sync_candidates(neighbour_nodes, longest_chain_length):
+            # Skip peers which cannot beat a chain we already downloaded
+            if height + 1 <= longest_chain_length:
+                continue
 
-            if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
+            # The chain is validated while it is downloaded
+            chain = self.download_chain(node)
 
-                # Check if the chain is longer and valid
-                if length > longest_chain_length and self.valid_chain(chain):
-                    longest_chain_length = length
-                    longer_chain = chain
+            # Check if the chain is longer and valid
+            if chain is not None and len(chain) > longest_chain_length:
+                longest_chain_length = len(chain)
+                longer_chain = chain
+            else:
+                self.network.record_failure(node)
 
         # Replace the chain if there is a longer and valid chain in the network
         if longer_chain:
-            self.chain = longer_chain
-            return True
+            with self.lock:
+                # Another writer may have extended our chain while we were downloading
+                if longest_chain_length > len(self.chain):
+                    self.replace_chain(longer_chain)
+                    return True
 
         return False
 
-    def valid_chain(self, chain):
+    def probe_node(self, node):
         """
-        Validate a given blockchain by checking the hash, the Proof of Work and the transactions for each block.
-        :param chain: <list> The blockchain
-        :return: <bool> True if valid, False if not
+        Request the status of a node and record its height and latency in the network.
+        :param node: <str> Network location of the node
+        :return: None
+        """
+
+        start = time()
+
+        try:
+            response = requests.get(f'http://{node}/node/status', timeout=self.network.timeout)
+            response.raise_for_status()
+            status = response.json()
+            height = status['height']
+            pruned_height = status.get('pruned_height', -1)
+
+            # A peer advertising a malformed status is treated like an unreachable one
+            if type(height) is not int or type(pruned_height) is not int or height < 0:
+                raise ValueError('Invalid status')
+            pruned = pruned_height >= 0
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            self.network.record_failure(node)
+            return
+
+        self.network.record_success(node, time() - start, height, pruned)
+
+    def download_chain(self, node):
+        """
+        Download the chain of a node and validate it while it arrives.
+        The download is abandoned at the first invalid block or when it exceeds the download deadline.
+        :param node: <str> Network location of the node
+        :return: <list> The valid chain of the node or None if the download failed or the chain is invalid
         """
 
-        previous_block = chain[0]
-        block_index = 1
+        # The timeout of the request only limits each read, a peer sending a byte now and then never hits it.
+        # The download runs in its own thread, so the deadline holds while a read is waiting for the peer.
+        download = {}
+        abandoned = threading.Event()
+        worker = threading.Thread(target=self.stream_chain, args=(node, abandoned, download),
+                                  name=f'download {node}', daemon=True)
+        worker.start()
+        worker.join(self.network.download_timeout)
+
+        if worker.is_alive():
+            # Close the connection, so the read the worker is waiting in fails at once and the worker ends.
+            # A response which arrives after this is closed by the worker itself.
+            abandoned.set()
+            response = download.get('response')
+            if response is not None:
+                self.close_response(response)
+            return None
+
+        return download.get('chain')
 
-        while block_index < len(chain):
-            current_block = chain[block_index]
+    @staticmethod
+    def close_response(response):
+        """
+        Close the connection of a streamed response from another thread than the one reading it.
+        :param response: <Response> Streamed response
+        :return: None
+        """
 
-            # Validate the hash of the block
-            if current_block['previous_block_hash'] != self.hash(previous_block):
-                return False
+        # The body is read from a file of the socket, also when the connection already let go of the socket,
+        # e.g. for an HTTP/1.0 response. Shutting the socket down wakes up a read which is waiting for data.
+        body = getattr(getattr(response.raw, '_fp', None), 'fp', None)
+        sock = getattr(getattr(body, 'raw', None), '_sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stream_chain(self, node, abandoned, download):
+        """
+        Download and validate the chain of a node, see download_chain.
+        :param node: <str> Network location of the node
+        :param abandoned: <Event> Set when the download exceeded its deadline
+        :param download: <dict> Receives the response while it is streamed and the valid chain
+        :return: None
+        """
 
-            # Validate the Proof of Work
-            if not ProofOfWork.valid_proof(current_block['transactions_hash'],
-                                           self.hash(previous_block),
-                                           current_block['nonce']):
-                return False
+        chain = []
+        validator = ChainValidator(self)
 
-            # Validate the transactions of the block
-            if current_block['transactions']:
-                coinbase_transactions = 0
-                for current_transaction in current_block['transactions']:
-                    # Count the amount of coinbase transactions in the block
-                    if current_transaction['sender'] == "0":
-                        coinbase_transactions += 1
-                    if not self.valid_transaction(current_transaction, chain, block_index):
-                        return False
-                # If the block contains more than one coinbase transaction return False
-                if coinbase_transactions > 1:
-                    return False
+        # Chains are large and repetitive, ask for a compressed response
+        headers = {'Accept-Encoding': compression.accept_encoding()}
 
-            previous_block = current_block
-            block_index += 1
+        try:
+            with requests.get(f'http://{node}/chain', headers=headers, timeout=self.network.timeout,
+                              stream=True) as response:
+                download['response'] = response
+                if abandoned.is_set():
+                    return
+                response.raise_for_status()
+
+                # Decode ourselves, which requests cannot do for every codec
+                chunks = compression.decompress_chunks(response.raw.stream(64 * 1024, decode_content=False),
+                                                       response.headers.get('Content-Encoding'))
+
+                for block in iter_chain_blocks(chunks):
+                    if abandoned.is_set():
+                        return
+
+                    block = Block.from_dict(block)
+                    if not validator.add_block(block):
+                        return
+                    chain.append(block)
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError, ValueError, KeyError, TypeError):
+            return
+
+        download['chain'] = chain
+
+    def valid_chain(self, chain, balances=None):
+        """
+        Validate a given blockchain by checking the hash, the Proof of Work and the transactions for each block.
+        A pruned chain starts with headers, the transactions after them are validated against the balances
+        after the last pruned block, see ChainIndex.pruned_balances.
+        :param chain: <list> The blockchain
+        :param balances: (Optional) <dict> Balances after the last pruned block, needed if the chain is pruned
+        :return: <bool> True if valid, False if not
+        """
+
+        validator = ChainValidator(self, balances)
+
+        for block in chain:
+            if not validator.add_block(Block.coerce(block)):
+                return False
 
         return True
 
-    def valid_transaction(self, signed_transaction, chain, block_index):
+    def valid_transaction(self, signed_transaction, chain, block_index, balances=None):
         """
         Validate the transaction on the blockchain.
         First the signature of the transaction is verified then it is
         checked if the sender had enough funds at the time of the transaction.
-        :param signed_transaction: <dict> Signed transaction
+        :param signed_transaction: <Transaction> Signed transaction
         :param chain: <list> The blockchain
         :param block_index: <int> Index of a block
+        :param balances: (Optional) <dict> Balances at the block index, used instead of scanning the chain
         :return: <bool> True if the transaction is valid, False if not
         """
 
-        sender = signed_transaction['sender']
-        amount = signed_transaction['amount']
+        sender = signed_transaction.sender
+        amount = signed_transaction.amount
 
         # Check if the miner rewarded himself more than 10 coins
         if sender == "0":
@@ -170,7 +486,10 @@ class Blockchain:
                     return False
 
                 # Get the balance of the sender
-                balance = self.address_balance_at_block_index(sender, chain, block_index)
+                if balances is not None:
+                    balance = balances.get(sender, 0)
+                else:
+                    balance = self.address_balance_at_block_index(sender, chain, block_index)
 
                 if amount <= balance:
                     return True
@@ -183,21 +502,13 @@ class Blockchain:
     def valid_signature(signed_transaction):
         """
         Verify the signature of a signed transaction.
-        :param signed_transaction: <dict> Signed transaction contains sender, recipient, amount and signature
+        :param signed_transaction: <Transaction> Signed transaction contains sender, recipient, amount and signature
         :return: <bool> True if the signature is valid, False if not
         """
 
-        transaction_content = {
-            'sender': signed_transaction['sender'],
-            'recipient': signed_transaction['recipient'],
-            'amount': signed_transaction['amount']
-        }
-
-        # Order the transaction to avoid inconsistent hashes
-        transaction_encoded = json.dumps(transaction_content, sort_keys=True).encode()
-        transaction_hash = hashlib.sha256(transaction_encoded).hexdigest()
+        transaction_hash = signed_transaction.signing_hash
 
-        signature = signed_transaction['signature']
+        signature = signed_transaction.signature
 
         # Get the public key of the sender which is needed for the verification
         try:
@@ -223,13 +534,13 @@ class Blockchain:
 
         while index < block_index:
             current_block = chain[index]
-            if current_block['transactions']:
-                transactions = current_block['transactions']
+            if current_block.transactions:
+                transactions = current_block.transactions
                 for current_transaction in transactions:
-                    if current_transaction['sender'] == address:
-                        balance -= current_transaction['amount']
-                    if current_transaction['recipient'] == address:
-                        balance += current_transaction['amount']
+                    if current_transaction.sender == address:
+                        balance -= current_transaction.amount
+                    if current_transaction.recipient == address:
+                        balance += current_transaction.amount
 
             index += 1
 
@@ -254,13 +565,13 @@ class Blockchain:
 
         while index < block_index:
             current_block = chain[index]
-            if current_block['transactions']:
-                transactions = current_block['transactions']
+            if current_block.transactions:
+                transactions = current_block.transactions
                 for current_transaction in transactions:
-                    if current_transaction['sender'] == address:
+                    if current_transaction.sender == address:
                         send_transactions.append(current_transaction)
                         number_of_transactions += 1
-                    elif current_transaction['recipient'] == address:
+                    elif current_transaction.recipient == address:
                         received_transactions.append(current_transaction)
                         number_of_transactions += 1
 
@@ -0,0 +1,83 @@
+import base64
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    Probabilistic set of strings. Membership tests never give false negatives
+    and give false positives with a configurable probability.
+    Positions are derived from a single SHA-256 with double hashing.
+    """
+
+    def __init__(self, size, hash_count, bits=None):
+        # Number of bits and number of positions set per item
+        self.size = size
+        self.hash_count = hash_count
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate=0.001):
+        """
+        Create a filter sized for a number of items and a false positive rate.
+        :param capacity: <int> Expected number of items
+        :param false_positive_rate: <float> Acceptable probability of false positives
+        :return: <BloomFilter> Empty filter
+        """
+
+        size = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        hash_count = max(1, round(size / capacity * math.log(2)))
+        return cls(size, hash_count)
+
+    def positions(self, item):
+        digest = hashlib.sha256(item.encode()).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:16], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        """
+        Add an item to the filter.
+        :param item: <str> Item
+        :return: None
+        """
+
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        for position in self.positions(item):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def to_dict(self):
+        """
+        Return the JSON representation of the filter, e.g. to send it to a node.
+        :return: <dict> Filter
+        """
+
+        return {
+            'size': self.size,
+            'hash_count': self.hash_count,
+            'bits': base64.b64encode(bytes(self.bits)).decode()
+        }
+
+    @classmethod
+    def from_dict(cls, bloom_filter):
+        """
+        Create a filter from its JSON representation.
+        :param bloom_filter: <dict> Filter
+        :return: <BloomFilter> Filter
+        :raises ValueError: If the filter is malformed
+        """
+
+        size = bloom_filter['size']
+        hash_count = bloom_filter['hash_count']
+        bits = base64.b64decode(bloom_filter['bits'], validate=True)
+
+        if not isinstance(size, int) or not isinstance(hash_count, int) or size <= 0 or \
+                not 0 < hash_count <= 64 or len(bits) != (size + 7) // 8:
+            raise ValueError('Malformed bloom filter')
+
+        return cls(size, hash_count, bits)
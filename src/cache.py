@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import hashlib
+import threading
+
+
+class ResponseCache:
+    """
+    Cache of serialized responses of the read endpoints.
+    Entries are only valid for the tip of the chain they were built for, all entries
+    are dropped as soon as a lookup sees a different tip, i.e. after a block was
+    added or the chain was replaced. Anything else a response depends on, like the
+    mempool version, has to be part of the key.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.tip_hash = None
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    @staticmethod
+    def etag(key, tip_hash):
+        """
+        Calculate the entity tag of a response.
+        :param key: <tuple> Cache key
+        :param tip_hash: <str> Hash of the last block of the chain
+        :return: <str> Entity tag
+        """
+
+        return hashlib.sha256(f'{tip_hash}{key!r}'.encode()).hexdigest()[:32]
+
+    def get(self, key, tip_hash):
+        """
+        Get a cached response.
+        :param key: <tuple> Cache key
+        :param tip_hash: <str> Hash of the last block of the chain
+        :return: <object> Cached response, e.g. the body and its content encoding, or None
+        """
+
+        with self.lock:
+            if tip_hash != self.tip_hash:
+                self.entries.clear()
+                self.tip_hash = tip_hash
+
+            response = self.entries.get(key)
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return response
+
+    def put(self, key, tip_hash, response):
+        """
+        Cache a response, evicting the oldest entry if the cache is full.
+        :param key: <tuple> Cache key
+        :param tip_hash: <str> Hash of the last block of the chain the response was built for
+        :param response: <object> Serialized response
+        :return: None
+        """
+
+        with self.lock:
+            # The tip changed while the response was built
+            if tip_hash != self.tip_hash:
+                return
+
+            self.entries[key] = response
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def record_not_modified(self):
+        with self.lock:
+            self.not_modified += 1
+
+    def stats(self):
+        """
+        Return the statistics of the cache.
+        :return: <dict> Hits, misses, 304 responses, hit rate and number of entries
+        """
+
+        with self.lock:
+            requests = self.hits + self.misses + self.not_modified
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified,
+                'hit_rate': (self.hits + self.not_modified) / requests if requests else 0.0,
+                'entries': len(self.entries)
+            }
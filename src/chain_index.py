@@ -0,0 +1,438 @@
+from bisect import bisect_left
+
+
+class PostingList:
+    """
+    Locations (height, position) of the transactions of an address in chain order.
+    Cursors are positions in the complete list. When transaction bodies are pruned
+    their locations are dropped from the front and only counted, so cursors stay valid.
+    Locations are only appended, pruning creates a new posting list, so readers never see
+    the locations shifted against the pruned count.
+    """
+
+    __slots__ = ('locations', 'pruned')
+
+    def __init__(self):
+        self.locations = []
+        # Number of locations dropped from the front
+        self.pruned = 0
+
+    def __len__(self):
+        return self.pruned + len(self.locations)
+
+    def append(self, location):
+        self.locations.append(location)
+
+    def length_at(self, height):
+        """
+        Get the number of locations up to a height, e.g. without a block which is still being indexed.
+        :param height: <int> Height of the last counted block
+        :return: <int> Number of locations including the pruned ones
+        """
+
+        locations = self.locations
+        end = len(locations)
+        while end and locations[end - 1][0] > height:
+            end -= 1
+        return self.pruned + end
+
+    def page(self, cursor, limit):
+        """
+        Get the locations of one page.
+        :param cursor: <int> Position of the first location of the page, pruned locations are skipped
+        :param limit: <int> Maximum number of locations
+        :return: locations: <list> Locations, cursor: <int> Position of the first returned location
+        """
+
+        start = max(cursor - self.pruned, 0)
+        return self.locations[start:start + limit], self.pruned + start
+
+    def prune(self, height):
+        """
+        Get the posting list without the locations of the transactions in blocks up to a height.
+        :param height: <int> Height of the last pruned block
+        :return: <PostingList> New posting list or this one if no location was dropped
+        """
+
+        count = 0
+        while count < len(self.locations) and self.locations[count][0] <= height:
+            count += 1
+
+        if not count:
+            return self
+
+        posting_list = PostingList()
+        posting_list.locations = self.locations[count:]
+        posting_list.pruned = self.pruned + count
+        return posting_list
+
+
+class ChainIndex:
+    """
+    Lookup indexes over a chain, maintained incrementally as blocks are appended.
+    The index keeps a reference to the chain list it describes, so a reader holding
+    an index always resolves locations against the matching chain, even if the
+    blockchain replaces its chain and index in the meantime. Blocks are appended
+    to the chain before they are indexed, so every indexed location is visible.
+    Pruning points the index to a copy of the chain with the headers of the pruned blocks.
+    Heights are positions in the chain, the genesis block has height 0.
+
+    Readers use the index while the writer changes it. Lists are only appended to or their last
+    entry is replaced, anything else, like dropping pruned entries, replaces the list, the same
+    way pruning replaces the chain.
+
+    The tip of the index is published once all indexes include the block. Readers answer at
+    the height of the tip, so the block which is still being indexed is not visible to them.
+    """
+
+    DIRECTIONS = ('all', 'sent', 'received')
+
+    def __init__(self, chain, state=None):
+        """
+        :param chain: <list> The blockchain
+        :param state: (Optional) <dict> State after the pruned blocks at the start of the chain, see pruned_state
+        """
+
+        self.chain = chain
+
+        # block hash -> height
+        self.block_heights = {}
+        # txid -> [(height, position in block)] in chain order, identical transactions share their id,
+        # e.g. coinbase transactions to the same address or payments signed with deterministic signatures
+        self.transaction_locations = {}
+        # address -> direction -> PostingList
+        self.address_postings = {}
+        # address -> balance at the tip of the chain
+        self.address_balances = {}
+        # address -> [(height, balance)] after every block which changed the balance, in chain order.
+        # Below the pruned height only the last checkpoint of each address is kept.
+        self.balance_checkpoints = {}
+        # Height of the last block whose transactions were removed from the index, -1 if nothing is pruned
+        self.pruned_height = -1
+        # (height, hash) of the last completely indexed block, replaced as a whole so readers get a matching pair
+        self.tip = (-1, None)
+
+        if state is not None:
+            self.pruned_height = state['pruned_height']
+            for address, balance in state['balances'].items():
+                self.address_balances[address] = balance
+                self.balance_checkpoints[address] = [(self.pruned_height, balance)]
+            for address, counts in state['transaction_counts'].items():
+                for direction, posting_list in self.postings(address).items():
+                    posting_list.pruned = counts[direction]
+
+        for height, block in enumerate(chain):
+            self.add_block(block, height)
+
+    def add_block(self, block, height):
+        """
+        Add a block and its transactions to the indexes.
+        :param block: <Block> Block which was appended to the chain
+        :param height: <int> Height of the block
+        :return: None
+        """
+
+        self.block_heights[block.hash] = height
+
+        for position, transaction in enumerate(block.transactions or []):
+            location = (height, position)
+            self.transaction_locations.setdefault(transaction.txid, []).append(location)
+
+            # A transaction to yourself only counts as sent, like in address_transactions_at_block_index
+            self.postings(transaction.sender)['sent'].append(location)
+            self.postings(transaction.sender)['all'].append(location)
+            if transaction.recipient != transaction.sender:
+                self.postings(transaction.recipient)['received'].append(location)
+                self.postings(transaction.recipient)['all'].append(location)
+
+            self.address_balances[transaction.sender] = \
+                self.address_balances.get(transaction.sender, 0) - transaction.amount
+            self.address_balances[transaction.recipient] = \
+                self.address_balances.get(transaction.recipient, 0) + transaction.amount
+
+            self.add_checkpoint(transaction.sender, height)
+            self.add_checkpoint(transaction.recipient, height)
+
+        # Publish the block only now that it is completely indexed
+        self.tip = (height, block.hash)
+
+    def add_checkpoint(self, address, height):
+        """
+        Record the current balance of an address as its balance after the block at a height.
+        :param address: <str> Address
+        :param height: <int> Height of the block which is being indexed
+        :return: None
+        """
+
+        checkpoints = self.balance_checkpoints.setdefault(address, [])
+        checkpoint = (height, self.address_balances[address])
+        if checkpoints and checkpoints[-1][0] == height:
+            checkpoints[-1] = checkpoint
+        else:
+            checkpoints.append(checkpoint)
+
+    def prune_block(self, block, height):
+        """
+        Remove the transactions of a block from the indexes before its body is dropped.
+        Balances are derived state and are kept, the balance checkpoints of the addresses of
+        the block are compacted to the last one up to this height.
+        :param block: <Block> Block whose transactions are pruned
+        :param height: <int> Height of the block
+        :return: None
+        """
+
+        # Raised first, readers which find compacted checkpoints also find the height as pruned
+        self.pruned_height = height
+
+        for position, transaction in enumerate(block.transactions or []):
+            # Blocks are pruned in chain order, so the pruned location is the first one of the transaction id
+            locations = self.transaction_locations.get(transaction.txid)
+            if locations and locations[0] == (height, position):
+                if len(locations) > 1:
+                    self.transaction_locations[transaction.txid] = locations[1:]
+                else:
+                    del self.transaction_locations[transaction.txid]
+
+            for address in (transaction.sender, transaction.recipient):
+                postings = self.address_postings[address]
+                for direction in self.DIRECTIONS:
+                    postings[direction] = postings[direction].prune(height)
+
+                checkpoints = self.balance_checkpoints[address]
+                count = self.checkpoints_up_to(checkpoints, height) - 1
+                if count > 0:
+                    self.balance_checkpoints[address] = checkpoints[count:]
+
+    def postings(self, address):
+        """
+        Get the posting lists of an address, creating them if necessary.
+        :param address: <str> Address
+        :return: <dict> Direction to PostingList
+        """
+
+        postings = self.address_postings.get(address)
+        if postings is None:
+            postings = {direction: PostingList() for direction in self.DIRECTIONS}
+            self.address_postings[address] = postings
+        return postings
+
+    def snapshot(self, height):
+        """
+        Return an immutable view of the chain up to a height, e.g. the published tip.
+        :param height: <int> Height of the last block
+        :return: <tuple> Blocks
+        """
+
+        return tuple(self.chain[:height + 1])
+
+    def block_by_hash(self, block_hash):
+        """
+        Get a block and its height by the hash of the block.
+        :param block_hash: <str> Hash of the block
+        :return: <tuple> (height, block) or None if the block is unknown
+        """
+
+        height = self.block_heights.get(block_hash)
+        if height is None:
+            return None
+        return height, self.chain[height]
+
+    def block_by_height(self, height):
+        """
+        Get a block by its height.
+        :param height: <int> Height of the block
+        :return: <Block> Block or None if there is no block at that height
+        """
+
+        if 0 <= height < len(self.chain):
+            return self.chain[height]
+        return None
+
+    def transactions_by_id(self, txid):
+        """
+        Get the transactions with a transaction id and their locations.
+        :param txid: <str> Transaction id
+        :return: <list> (height, block, position, transaction) in chain order, empty if the transaction is unknown
+        """
+
+        transactions = []
+        for height, position in list(self.transaction_locations.get(txid, [])):
+            block = self.chain[height]
+
+            # The body of the block may have been pruned since the index was read
+            if block.transactions is not None:
+                transactions.append((height, block, position, block.transactions[position]))
+
+        return transactions
+
+    def address_balance(self, address):
+        """
+        Get the balance of an address at the tip of the chain.
+        :param address: <str> Address
+        :return: <int> Balance of the address
+        """
+
+        return self.address_balances.get(address, 0)
+
+    def address_balance_at_height(self, address, height):
+        """
+        Get the balance of an address after the block at a height with a binary search over its checkpoints.
+        :param address: <str> Address
+        :param height: <int> Height of the block
+        :return: <int> Balance of the address or None if the checkpoints up to that height were pruned
+        """
+
+        # Take the checkpoints before the pruned height, which is raised before checkpoints are compacted
+        checkpoints = self.balance_checkpoints.get(address, [])
+        if height < self.pruned_height:
+            return None
+
+        position = self.checkpoints_up_to(checkpoints, height)
+        return checkpoints[position - 1][1] if position else 0
+
+    @staticmethod
+    def checkpoints_up_to(checkpoints, height):
+        """
+        Get the number of balance checkpoints up to a height with a binary search.
+        :param checkpoints: <list> (height, balance) checkpoints of an address
+        :param height: <int> Height of the last counted block
+        :return: <int> Number of checkpoints
+        """
+
+        # (height + 1,) sorts before every checkpoint at height + 1 and after every checkpoint up to height
+        return bisect_left(checkpoints, (height + 1,))
+
+    def pruned_balances(self):
+        """
+        Get the balances after the last pruned block, e.g. to validate the retained part of a pruned chain.
+        :return: <dict> Address to balance, empty if nothing is pruned
+        """
+
+        if self.pruned_height < 0:
+            return {}
+
+        # The checkpoints up to the pruned height are compacted to the last one
+        return {address: checkpoints[0][1] for address, checkpoints in self.balance_checkpoints.items()
+                if checkpoints and checkpoints[0][0] <= self.pruned_height}
+
+    def pruned_state(self):
+        """
+        Get the state derived from the pruned transactions, which cannot be rebuilt from the pruned chain.
+        :return: <dict> Pruned height, balances after the pruned blocks and number of pruned transactions per address
+        """
+
+        return {
+            'pruned_height': self.pruned_height,
+            'balances': self.pruned_balances(),
+            'transaction_counts': {
+                address: {direction: posting_list.pruned for direction, posting_list in postings.items()}
+                for address, postings in self.address_postings.items() if postings['all'].pruned
+            }
+        }
+
+    def balance_history(self, address, start_height=0, end_height=None, limit=1000):
+        """
+        Get the balance changes of an address between two heights, e.g. to chart the balance.
+        The range has to start after the pruned height.
+        :param address: <str> Address
+        :param start_height: <int> Height of the first block of the range
+        :param end_height: <int> Height of the last block of the range, the published tip if None
+        :param limit: <int> Maximum number of changes
+        :return: opening_balance: <int> Balance before the range or None if it was pruned,
+        changes: <list> (height, balance) tuples of the blocks which changed the balance,
+        next_height: <int> Start height of the next page or None if this is the last page
+        """
+
+        if end_height is None:
+            end_height = self.tip[0]
+
+        # The opening balance and the changes are taken from the same checkpoints, see address_balance_at_height
+        checkpoints = self.balance_checkpoints.get(address, [])
+        if start_height - 1 < self.pruned_height:
+            return None, [], None
+
+        start = self.checkpoints_up_to(checkpoints, start_height - 1)
+        end = self.checkpoints_up_to(checkpoints, end_height)
+        stop = min(end, start + limit)
+
+        opening_balance = checkpoints[start - 1][1] if start else 0
+        changes = checkpoints[start:stop]
+        next_height = checkpoints[stop][0] if stop < end else None
+
+        return opening_balance, changes, next_height
+
+    def address_history(self, address, direction='all', cursor=0, limit=100, end_height=None):
+        """
+        Get one page of the transaction history of an address in chain order.
+        The cursor is a position in the posting list of the address, which only grows
+        while the chain is extended, so a page costs the same regardless of the history size.
+        Transactions of pruned blocks are skipped.
+        :param address: <str> Address
+        :param direction: <str> 'all', 'sent' or 'received'
+        :param cursor: <int> Position of the first transaction of the page
+        :param limit: <int> Maximum number of transactions in the page
+        :param end_height: <int> Height of the last block of the history, the published tip if None
+        :return: transactions: <list> (height, position, transaction) tuples,
+        next_cursor: <int> Cursor of the next page or None if this is the last page
+        """
+
+        postings = self.address_postings.get(address)
+        if postings is None:
+            return [], None
+
+        if end_height is None:
+            end_height = self.tip[0]
+
+        posting_list = postings[direction]
+        page, start = posting_list.page(cursor, limit)
+        page = [location for location in page if location[0] <= end_height]
+
+        transactions = []
+        for height, position in page:
+            block = self.chain[height]
+            # The body of the block may have been pruned since the page was read
+            if block.transactions is not None:
+                transactions.append((height, position, block.transactions[position]))
+
+        next_cursor = start + len(page)
+        if next_cursor >= posting_list.length_at(end_height):
+            next_cursor = None
+
+        return transactions, next_cursor
+
+    def number_of_transactions(self, address, direction='all', end_height=None):
+        """
+        Get the number of transactions of an address, including those of pruned blocks.
+        :param address: <str> Address
+        :param direction: <str> 'all', 'sent' or 'received'
+        :param end_height: <int> Height of the last block to count, the published tip if None
+        :return: <int> Number of transactions
+        """
+
+        postings = self.address_postings.get(address)
+        if postings is None:
+            return 0
+        return postings[direction].length_at(self.tip[0] if end_height is None else end_height)
+
+    def matching_transactions(self, bloom_filter, start_height=0, max_blocks=1000):
+        """
+        Get the transactions whose sender or recipient matches a bloom filter of a client.
+        The filter can match foreign addresses, the client checks the matches against its own addresses.
+        :param bloom_filter: <BloomFilter> Filter of the addresses of the client
+        :param start_height: <int> Height of the first block to scan
+        :param max_blocks: <int> Maximum number of blocks to scan
+        :return: transactions: <list> (height, position, transaction) tuples,
+        next_height: <int> Height to continue from, the length of the chain if all blocks were scanned
+        """
+
+        chain = self.chain
+        end_height = min(start_height + max_blocks, len(chain))
+
+        transactions = []
+        for height in range(start_height, end_height):
+            # Blocks whose transactions were pruned have nothing to match
+            for position, transaction in enumerate(chain[height].transactions or []):
+                if transaction.sender in bloom_filter or transaction.recipient in bloom_filter:
+                    transactions.append((height, position, transaction))
+
+        return transactions, max(end_height, start_height)
@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+
+from src.block import Block
+
+
+class ChainStore:
+    """
+    The blocks of the chain on disk, one JSON block per line, shared by the processes of a node.
+    A single writer process appends every block it adds to the file and rewrites the file when it
+    replaces the chain. Reader processes follow the file: they apply the lines appended since their
+    last sync and reload the whole chain when the file was rewritten, which gives it a new inode.
+    Only complete lines are read, so readers never see a block which is still being written.
+
+    In pruned mode the writer compacts the file now and then: it rewrites the chain with the headers
+    of the pruned blocks, preceded by a state line with what the index derived from their transactions.
+    """
+
+    FILENAME = 'chain.jsonl'
+    # Number of newly pruned blocks after which the file is compacted
+    COMPACT_INTERVAL = 1000
+
+    def __init__(self, data_dir):
+        os.makedirs(data_dir, exist_ok=True)
+        self.path = os.path.join(data_dir, self.FILENAME)
+
+        # Position up to which a reader applied the file and the inode of that file
+        self.offset = 0
+        self.inode = None
+        self.lock = threading.Lock()
+
+        # Pruned height of the state in the file, -1 if the file has no pruned blocks
+        self.compacted_height = -1
+
+    @staticmethod
+    def encode(block):
+        return (json.dumps(block.to_dict(), sort_keys=True) + '\n').encode()
+
+    def read(self, offset):
+        """
+        Read the complete blocks of the file from a position on.
+        :param offset: <int> Position in the file, 0 for the whole file
+        :return: blocks: <list> Blocks, state: <dict> State of the pruned blocks or None,
+        offset: <int> Position after the last complete line, inode: <int> Inode of the file which was read
+        or None if there is no file
+        """
+
+        try:
+            with open(self.path, 'rb') as file:
+                inode = os.fstat(file.fileno()).st_ino
+                file.seek(offset)
+                data = file.read()
+        except FileNotFoundError:
+            return [], None, 0, None
+
+        end = data.rfind(b'\n') + 1
+        blocks = []
+        state = None
+        for line in data[:end].splitlines():
+            values = json.loads(line)
+            if 'state' in values:
+                state = values['state']
+            else:
+                blocks.append(Block.from_dict(values))
+        return blocks, state, offset + end, inode
+
+    def load(self):
+        """
+        Load the chain when the writer starts. A partially written last block is dropped.
+        :return: blocks: <list> Blocks of the stored chain, empty if nothing is stored,
+        state: <dict> State of the pruned blocks, see ChainIndex.pruned_state, or None
+        """
+
+        blocks, state, offset, inode = self.read(0)
+        if inode is not None and os.path.getsize(self.path) > offset:
+            os.truncate(self.path, offset)
+        self.compacted_height = state['pruned_height'] if state is not None else -1
+        return blocks, state
+
+    def append(self, block):
+        """
+        Append a block which the writer added to the chain.
+        :param block: <Block> Block
+        :return: None
+        """
+
+        with open(self.path, 'ab') as file:
+            file.write(self.encode(block))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def write(self, chain, state=None):
+        """
+        Replace the stored chain. The new file is moved into place, so readers
+        see either the old or the new chain.
+        :param chain: <list> Blocks of the new chain
+        :param state: (Optional) <dict> State of the pruned blocks at the start of the chain
+        :return: None
+        """
+
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            if state is not None:
+                file.write((json.dumps({'state': state}, sort_keys=True) + '\n').encode())
+            for block in chain:
+                file.write(self.encode(block))
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temporary_path, self.path)
+        self.compacted_height = state['pruned_height'] if state is not None else -1
+
+    def sync(self, blockchain):
+        """
+        Bring the chain of a reader up to date with the stored chain.
+        :param blockchain: <Blockchain> Blockchain of the reader process
+        :return: None
+        """
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+
+        inode, size = stat.st_ino, stat.st_size
+
+        with self.lock:
+            if inode == self.inode and size <= self.offset:
+                return
+
+            if inode == self.inode:
+                blocks, _, offset, inode = self.read(self.offset)
+
+            if inode != self.inode:
+                # The file was rewritten, the chain was replaced or compacted
+                blocks, state, offset, inode = self.read(0)
+                if blocks:
+                    with blockchain.lock:
+                        blockchain.replace_chain(blocks, state)
+            else:
+                with blockchain.lock:
+                    for block in blocks:
+                        blockchain.add_block(block)
+
+            self.offset = offset
+            self.inode = inode
@@ -0,0 +1,65 @@
+import codecs
+import json
+import re
+
+# Start of the array of blocks in the response of the /chain endpoint
+CHAIN_START = re.compile(r'"chain"\s*:\s*\[')
+WHITESPACE = re.compile(r'[\s,]*')
+
+# Give up on peers which send more than this many characters without completing a block
+MAX_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def iter_chain_blocks(chunks):
+    """
+    Parse the blocks of a /chain response incrementally while it is downloaded.
+    Each block is yielded as soon as it is complete, so it can be validated
+    before the rest of the response has arrived.
+    :param chunks: <iterable> Chunks of the response body as bytes
+    :return: <generator> Blocks as dicts
+    :raises ValueError: If the response is not a valid chain
+    """
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = None
+
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+
+        # Skip everything before the array of blocks
+        if position is None:
+            match = CHAIN_START.search(buffer)
+            if match is None:
+                if len(buffer) > MAX_BLOCK_SIZE:
+                    raise ValueError('Response does not contain a chain')
+                continue
+            position = match.end()
+
+        while True:
+            position = WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            if buffer[position] == ']':
+                return
+
+            try:
+                block, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The block is not complete yet
+                break
+
+            if not isinstance(block, dict):
+                raise ValueError('Block is not an object')
+            yield block
+            position = end
+
+        # Drop the parsed part of the buffer
+        buffer = buffer[position:]
+        position = 0
+
+        if len(buffer) > MAX_BLOCK_SIZE:
+            raise ValueError('Block is too large')
+
+    raise ValueError('Chain ended unexpectedly')
@@ -0,0 +1,88 @@
+from src.block import BlockHeader
+from src.proof_of_work import ProofOfWork
+
+
+class ChainValidator:
+    """
+    Validates a chain one block at a time, so a chain can be checked while it is
+    downloaded and rejected at the first invalid block. The balances of all
+    addresses are kept up to date as blocks are added, which avoids rescanning
+    the chain for every transaction.
+
+    A pruned chain starts with headers, whose link and Proof of Work are checked. Headers are only
+    accepted together with the balances after the last pruned block, i.e. for the own chain of a node,
+    which validate the transactions after them. Without the balances a chain of headers would replace
+    any chain and its state with forged blocks, so headers are rejected.
+    """
+
+    def __init__(self, blockchain, balances=None):
+        """
+        :param blockchain: <Blockchain> Blockchain used to validate transactions
+        :param balances: (Optional) <dict> Balances after the last pruned block, needed if the chain starts with headers
+        """
+
+        self.blockchain = blockchain
+        self.previous_block = None
+        # Balances after the validated blocks, the genesis block is not counted like in address_balance_at_block_index
+        self.balances = dict(balances or {})
+        self.pruned_balances_known = balances is not None
+        # True after a header, respectively a block with transactions, was validated
+        self.pruned = False
+        self.unpruned = False
+
+    def add_block(self, block):
+        """
+        Validate the next block of the chain by checking the hash, the Proof of Work and the transactions.
+        The first block is the genesis block and is accepted as it is.
+        :param block: <Block> Next block of the chain
+        :return: <bool> True if valid, False if not
+        """
+
+        previous_block = self.previous_block
+        self.previous_block = block
+
+        if isinstance(block, BlockHeader) and not self.pruned_balances_known:
+            return False
+
+        if previous_block is None:
+            self.pruned = isinstance(block, BlockHeader)
+            return True
+
+        # Validate the hash of the block
+        if block.previous_block_hash != previous_block.hash:
+            return False
+
+        # Validate the Proof of Work
+        if not ProofOfWork.valid_proof(block.transactions_hash, previous_block.hash, block.nonce):
+            return False
+
+        if isinstance(block, BlockHeader):
+            # Pruned blocks can only precede the blocks with transactions
+            if self.unpruned:
+                return False
+            self.pruned = True
+            return True
+
+        self.unpruned = True
+
+        # Validate the transactions of the block
+        if block.transactions:
+            coinbase_transactions = 0
+            for current_transaction in block.transactions:
+                # Count the amount of coinbase transactions in the block
+                if current_transaction.sender == "0":
+                    coinbase_transactions += 1
+                if not self.blockchain.valid_transaction(current_transaction, None, None, self.balances):
+                    return False
+            # If the block contains more than one coinbase transaction return False
+            if coinbase_transactions > 1:
+                return False
+
+            # Transactions only count towards the balances once their block is complete
+            for current_transaction in block.transactions:
+                self.balances[current_transaction.sender] = \
+                    self.balances.get(current_transaction.sender, 0) - current_transaction.amount
+                self.balances[current_transaction.recipient] = \
+                    self.balances.get(current_transaction.recipient, 0) + current_transaction.amount
+
+        return True
@@ -0,0 +1,90 @@
+import gzip
+import zlib
+
+# Optional faster codec, gzip is used if it is not installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Supported content encodings in order of preference
+ENCODINGS = ('zstd', 'gzip') if zstandard else ('gzip',)
+
+# Responses smaller than this are not worth compressing
+MIN_SIZE = 1024
+
+
+def accept_encoding():
+    """
+    Value of the Accept-Encoding header for requests to peers.
+    :return: <str> Supported content encodings
+    """
+
+    return ', '.join(ENCODINGS)
+
+
+def negotiate(accept_encoding_header):
+    """
+    Choose the content encoding of a response from the Accept-Encoding header of the request.
+    :param accept_encoding_header: <str> Accept-Encoding header or None
+    :return: <str> Preferred supported encoding or None for an uncompressed response
+    """
+
+    accepted = set()
+    for part in (accept_encoding_header or '').split(','):
+        coding, _, parameters = part.strip().partition(';')
+        quality = parameters.strip()
+        if quality.startswith('q='):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    """
+    Compress a response body.
+    :param body: <bytes> Response body
+    :param encoding: <str> Content encoding
+    :return: <bytes> Compressed body
+    """
+
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(body)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    raise ValueError(f'Unsupported encoding {encoding}')
+
+
+def decompress_chunks(chunks, encoding):
+    """
+    Decompress a response body chunk by chunk while it is downloaded.
+    :param chunks: <iterable> Chunks of the raw response body as bytes
+    :param encoding: <str> Content-Encoding of the response or None
+    :return: <generator> Decompressed chunks
+    :raises ValueError: If the encoding is not supported
+    """
+
+    if not encoding or encoding == 'identity':
+        yield from chunks
+        return
+
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'zstd' and zstandard is not None:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        raise ValueError(f'Unsupported encoding {encoding}')
+
+    try:
+        for chunk in chunks:
+            yield decompressor.decompress(chunk)
+    except (zlib.error, getattr(zstandard, 'ZstdError', zlib.error)) as error:
+        raise ValueError(f'Invalid {encoding} data') from error
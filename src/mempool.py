@@ -1,24 +1,56 @@
 import hashlib
 import json
 
+from src.transaction import Transaction
+
 
 class Mempool:
     def __init__(self):
         self.current_transactions = []
 
+        # Incremented whenever the transactions in the mempool change
+        self.version = 0
+
     def add_transaction(self, signed_transaction, blockchain):
         """
         Add a valid, signed transaction to the mempool.
-        :param signed_transaction: <dict> Signed transaction
+        :param signed_transaction: <Transaction> or <dict> Signed transaction
         :param blockchain: <object> Blockchain object
         :return: <bool> True if the transaction is added to the mempool, False if not
         """
 
-        if self.valid_transaction(signed_transaction, blockchain):
-            self.current_transactions.append(signed_transaction)
-            return True
-        else:
-            return False
+        signed_transaction = Transaction.coerce(signed_transaction)
+
+        # Validation and insertion must not interleave with block creation
+        with blockchain.lock:
+            if self.valid_transaction(signed_transaction, blockchain):
+                self.current_transactions.append(signed_transaction)
+                self.version += 1
+                return True
+            else:
+                return False
+
+    def remove_transactions(self, transactions):
+        """
+        Remove transactions which were included in a block from the mempool.
+        Transactions which arrived in the meantime stay queued for the next block.
+        The list is replaced instead of modified so snapshots held by readers stay intact.
+        :param transactions: <list> Transactions included in a block
+        :return: None
+        """
+
+        included = {id(transaction) for transaction in transactions or []}
+        self.current_transactions = [transaction for transaction in self.current_transactions
+                                     if id(transaction) not in included]
+        self.version += 1
+
+    def snapshot(self):
+        """
+        Return an immutable view of the transactions currently in the mempool.
+        :return: <tuple> Transactions
+        """
+
+        return tuple(self.current_transactions)
 
     @staticmethod
     def hash(transactions):
@@ -29,34 +61,38 @@ class Mempool:
         """
 
         # Order the transactions to avoid inconsistent hashes
-        block_encoded = json.dumps(transactions, sort_keys=True).encode()
+        block_encoded = json.dumps(transactions, sort_keys=True, default=lambda o: o.to_dict()).encode()
         return hashlib.sha256(block_encoded).hexdigest()
 
     def valid_transaction(self, signed_transaction, blockchain):
         """
         Validate the transaction by first checking the mempool for transactions of the sender then the
         signature of the transaction is verified and finally it is checked if the sender has enough funds.
-        :param signed_transaction: <dict> Signed transaciton
+        :param signed_transaction: <Transaction> or <dict> Signed transaciton
         :param blockchain: <object> Blockchain object
         :return: <bool> True if the transaction is valid, False if not
         """
 
+        signed_transaction = Transaction.coerce(signed_transaction)
+
         # Check if the amount of coins to send is negative
-        amount = signed_transaction['amount']
+        amount = signed_transaction.amount
 
         if amount < 0:
             return False
 
-        sender = signed_transaction['sender']
+        sender = signed_transaction.sender
 
         # Check if a transaction of the sender already exists in the mempool
         for current_transaction in self.current_transactions:
             # Reject if a transaction from the sender already exists
-            if current_transaction['sender'] == sender:
+            if current_transaction.sender == sender:
                 return False
 
         # Validate the signature of the transaction and check if the sender has enough funds
-        if not blockchain.valid_transaction(signed_transaction, blockchain.chain, blockchain.last_block['index']):
+        # The balances of the index are used because the transactions of old blocks may be pruned
+        if not blockchain.valid_transaction(signed_transaction, blockchain.chain, blockchain.last_block.index,
+                                            blockchain.index.address_balances):
             return False
         else:
             return True
@@ -1,9 +1,58 @@
+import threading
+from time import time
 from urllib.parse import urlparse
 
 
+class Peer:
+    """
+    Health information about a node of the network.
+    """
+
+    __slots__ = ('netloc', 'latency', 'failures', 'last_seen', 'height', 'pruned', 'retry_at')
+
+    def __init__(self, netloc):
+        self.netloc = netloc
+        # Exponentially weighted moving average of the response time in seconds, None until first contact
+        self.latency = None
+        # Number of consecutive failed requests
+        self.failures = 0
+        self.last_seen = None
+        # Height of the last block the peer advertised, None until first contact
+        self.height = None
+        # Pruned peers dropped old transactions and cannot serve their full chain
+        self.pruned = False
+        # The peer is not contacted again before this time
+        self.retry_at = 0
+
+    def to_dict(self):
+        return {
+            'netloc': self.netloc,
+            'latency': self.latency,
+            'failures': self.failures,
+            'last_seen': self.last_seen,
+            'height': self.height,
+            'pruned': self.pruned,
+            'retry_at': self.retry_at
+        }
+
+
 class Network:
-    def __init__(self):
-        self.nodes = set()
+    # Weight of a new latency measurement in the moving average
+    LATENCY_WEIGHT = 0.3
+    # Backoff after the first failure, doubled with each consecutive failure up to the maximum
+    BACKOFF = 1.0
+    MAX_BACKOFF = 300.0
+
+    def __init__(self, max_active_peers=8, timeout=2.0, download_timeout=120.0):
+        # netloc -> Peer
+        self.nodes = {}
+        # Maximum number of peers contacted in one round of consensus
+        self.max_active_peers = max_active_peers
+        # Timeout in seconds for the status requests to peers and for each read of a download
+        self.timeout = timeout
+        # Deadline in seconds for downloading a whole chain, so a peer sending slowly cannot stall consensus
+        self.download_timeout = download_timeout
+        self.lock = threading.Lock()
 
     def register_node(self, address):
         """
@@ -15,4 +64,91 @@ class Network:
         parsed_url = urlparse(address)
 
         if parsed_url.netloc:
-            self.nodes.add(parsed_url.netloc)
+            with self.lock:
+                if parsed_url.netloc not in self.nodes:
+                    self.nodes[parsed_url.netloc] = Peer(parsed_url.netloc)
+
+    def record_success(self, netloc, latency, height=None, pruned=None):
+        """
+        Record a successful request to a peer.
+        :param netloc: <str> Network location of the peer
+        :param latency: <float> Response time in seconds
+        :param height: (Optional) <int> Height advertised by the peer
+        :param pruned: (Optional) <bool> True if the peer advertised that it pruned transactions
+        :return: None
+        """
+
+        with self.lock:
+            peer = self.nodes.get(netloc)
+            if peer is None:
+                return
+
+            if peer.latency is None:
+                peer.latency = latency
+            else:
+                peer.latency += self.LATENCY_WEIGHT * (latency - peer.latency)
+            if height is not None:
+                peer.height = height
+            if pruned is not None:
+                peer.pruned = pruned
+            peer.failures = 0
+            peer.last_seen = time()
+            peer.retry_at = 0
+
+    def record_failure(self, netloc):
+        """
+        Record a failed request to a peer and back off exponentially.
+        :param netloc: <str> Network location of the peer
+        :return: None
+        """
+
+        with self.lock:
+            peer = self.nodes.get(netloc)
+            if peer is None:
+                return
+
+            peer.failures += 1
+            backoff = min(self.BACKOFF * 2 ** (peer.failures - 1), self.MAX_BACKOFF)
+            peer.retry_at = time() + backoff
+
+    def active_peers(self):
+        """
+        Select the peers to contact in the next round of consensus. Peers which are backing off are
+        skipped, the rest is ordered by consecutive failures and latency and capped at max_active_peers.
+        Peers which were never contacted have no latency yet and are tried first to measure them.
+        :return: <list> Network locations of the selected peers
+        """
+
+        now = time()
+
+        with self.lock:
+            available = [peer for peer in self.nodes.values() if peer.retry_at <= now]
+
+        available.sort(key=lambda peer: (peer.failures, peer.latency or 0))
+        return [peer.netloc for peer in available[:self.max_active_peers]]
+
+    def sync_candidates(self, netlocs, length):
+        """
+        Order the peers which advertised a chain longer than ours, highest and then fastest first.
+        Pruned peers cannot serve their full chain and are left out.
+        :param netlocs: <list> Network locations of the contacted peers
+        :param length: <int> Length of our chain
+        :return: <list> (network location, advertised height) of the peers to download a chain from
+        """
+
+        with self.lock:
+            peers = [(netloc, self.nodes[netloc].height, self.nodes[netloc].latency) for netloc in netlocs
+                     if netloc in self.nodes and self.nodes[netloc].failures == 0 and not self.nodes[netloc].pruned
+                     and self.nodes[netloc].height is not None and self.nodes[netloc].height + 1 > length]
+
+        peers.sort(key=lambda peer: (-peer[1], peer[2]))
+        return [(netloc, height) for netloc, height, _ in peers]
+
+    def stats(self):
+        """
+        Return the health information of all peers.
+        :return: <list> Peers as dicts
+        """
+
+        with self.lock:
+            return [peer.to_dict() for peer in self.nodes.values()]
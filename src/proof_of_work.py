@@ -2,19 +2,31 @@ import hashlib
 
 
 class ProofOfWork:
+    # Number of leading zeroes required in the hash of a valid proof
+    DIFFICULTY = 4
+    TARGET = '0' * DIFFICULTY
+
     @staticmethod
-    def proof_of_work(transactions_hash, previous_block_hash):
+    def proof_of_work(transactions_hash, previous_block_hash, start=0, step=1, attempts=None):
         """
         Simple Proof of Work algorithm based on the hash of the transactions included in this block and the last block.
         Try a different nonce (brute-force search) until a valid hash is found.
+        Several miners can split the search by starting at different nonces and stepping by the number of miners.
         :param transactions_hash: <int> Hash of the transactions
         :param previous_block_hash: <str> Hash of the previous block
-        :return: nonce: <int> Valid nonce
+        :param start: (Optional) <int> First nonce to try
+        :param step: (Optional) <int> Distance between the tried nonces
+        :param attempts: (Optional) <int> Give up after this many nonces
+        :return: nonce: <int> Valid nonce or None if no valid nonce was found within the attempts
         """
 
-        nonce = 0
+        nonce = start
         while ProofOfWork.valid_proof(transactions_hash, previous_block_hash, nonce) is False:
-            nonce += 1
+            nonce += step
+            if attempts is not None:
+                attempts -= 1
+                if attempts <= 0:
+                    return None
 
         return nonce
 
@@ -30,4 +42,4 @@ class ProofOfWork:
 
         encoded = f'{transactions_hash}{previous_block_hash}{nonce}'.encode()
         hashed = hashlib.sha256(encoded).hexdigest()
-        return hashed[:4] == "0000"
+        return hashed[:ProofOfWork.DIFFICULTY] == ProofOfWork.TARGET
@@ -0,0 +1,108 @@
+import hashlib
+import json
+
+
+class Transaction:
+    """
+    A transfer of coins from a sender to a recipient.
+    Uses __slots__ instead of a dict per transaction to keep large chains small in memory.
+    Coinbase transactions may come without a signature, which is stored as None and omitted when serialized.
+    """
+
+    __slots__ = ('sender', 'recipient', 'amount', 'signature', '_txid')
+
+    FIELDS = ('sender', 'recipient', 'amount', 'signature')
+
+    def __init__(self, sender, recipient, amount, signature=None):
+        self.sender = sender
+        self.recipient = recipient
+        self.amount = amount
+        self.signature = signature
+        self._txid = None
+
+    @classmethod
+    def from_dict(cls, transaction):
+        """
+        Create a transaction from its JSON representation.
+        :param transaction: <dict> Transaction
+        :return: <Transaction> Transaction
+        """
+
+        return cls(transaction['sender'], transaction['recipient'], transaction['amount'],
+                   transaction.get('signature'))
+
+    @classmethod
+    def coerce(cls, transaction):
+        """
+        Return the transaction as a Transaction object, converting it if it is a dict.
+        :param transaction: <Transaction> or <dict> Transaction
+        :return: <Transaction> Transaction
+        """
+
+        if isinstance(transaction, cls):
+            return transaction
+        return cls.from_dict(transaction)
+
+    def to_dict(self):
+        """
+        Return the JSON representation of the transaction.
+        :return: <dict> Transaction
+        """
+
+        transaction = {
+            'sender': self.sender,
+            'recipient': self.recipient,
+            'amount': self.amount
+        }
+        if self.signature is not None:
+            transaction['signature'] = self.signature
+        return transaction
+
+    @property
+    def signing_hash(self):
+        """
+        SHA-256 hash of the content of the transaction which is signed by the sender.
+        :return: <str> Hash of sender, recipient and amount
+        """
+
+        transaction_content = {
+            'sender': self.sender,
+            'recipient': self.recipient,
+            'amount': self.amount
+        }
+
+        # Order the transaction to avoid inconsistent hashes
+        transaction_encoded = json.dumps(transaction_content, sort_keys=True).encode()
+        return hashlib.sha256(transaction_encoded).hexdigest()
+
+    @property
+    def txid(self):
+        """
+        Id of the transaction, the SHA-256 hash of the signed transaction. Calculated once and cached.
+        Identical transactions, e.g. coinbase transactions paying the same address, share the same id.
+        :return: <str> Transaction id
+        """
+
+        if self._txid is None:
+            transaction_encoded = json.dumps(self.to_dict(), sort_keys=True).encode()
+            self._txid = hashlib.sha256(transaction_encoded).hexdigest()
+        return self._txid
+
+    def __getitem__(self, key):
+        # Allow dict style access for code written against the JSON representation
+        if key not in self.FIELDS or (key == 'signature' and self.signature is None):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        if not isinstance(other, Transaction):
+            return NotImplemented
+        return (self.sender, self.recipient, self.amount, self.signature) == \
+               (other.sender, other.recipient, other.amount, other.signature)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Transaction({self.to_dict()!r})'
@@ -1,17 +1,43 @@
 from bitcoin import *
-import hashlib
+import json
+import os
+import threading
 
-from src.blockchain import Blockchain
+from src.transaction import Transaction
 
 
 class Wallet:
-    def __init__(self):
+    def __init__(self, path=None):
+        """
+        :param path: (Optional) <str> File which keeps the private keys across restarts,
+        the keys are only kept in memory if None
+        """
+
+        self.path = path
         self.addresses = []
         self.address_to_keys = {}
         self.address_to_balance = {}
 
-        # Initialize wallet with one address and corresponding key pair
-        private_key = random_key()
+        # Serializes changes to the addresses and balances of the wallet
+        self.lock = threading.Lock()
+
+        stored_private_keys = self.load_private_keys()
+
+        if stored_private_keys:
+            for private_key in stored_private_keys:
+                self.add_key_pair(private_key)
+        else:
+            # Initialize wallet with one address and corresponding key pair
+            self.add_key_pair(random_key())
+            self.save_private_keys()
+
+    def add_key_pair(self, private_key):
+        """
+        Add the key pair of a private key to the wallet. The caller must hold the lock once the wallet is shared.
+        :param private_key: <str> Private key
+        :return: address: <str> Address of the key pair
+        """
+
         public_key = privtopub(private_key)
         address = pubtoaddr(public_key)
 
@@ -19,6 +45,39 @@ class Wallet:
         self.address_to_keys[address] = [private_key, public_key]
         self.address_to_balance[address] = 0
 
+        return address
+
+    def load_private_keys(self):
+        """
+        Load the private keys of the wallet file.
+        :return: <list> Private keys in the order the addresses were created, empty if there is no wallet file
+        """
+
+        if self.path is None or not os.path.exists(self.path):
+            return []
+
+        with open(self.path) as file:
+            return json.load(file)['private_keys']
+
+    def save_private_keys(self):
+        """
+        Write the private keys to the wallet file, readable by the owner only.
+        The new file is moved into place, so a crash leaves the old or the new file.
+        :return: None
+        """
+
+        if self.path is None:
+            return
+
+        temporary_path = self.path + '.tmp'
+        descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump({'private_keys': [self.address_to_keys[address][0] for address in self.addresses]}, file)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temporary_path, self.path)
+
     def total_balance(self):
         """
         Returns the total balance of the wallet by adding up the balance of each address.
@@ -31,31 +90,33 @@ class Wallet:
 
         return total_balance
 
-    def update_balances(self, chain):
+    def update_balances(self, index, height=None):
         """
-        Update the balance for each address.
-        :param chain: <list> The blockchain
-        :return: None
+        Update the balance for each address from the balances of the chain index,
+        which also cover the transactions of pruned blocks.
+        :param index: <ChainIndex> Index of the current chain
+        :param height: (Optional) <int> Height of the block the balances are taken after, the last indexed one if None
+        :return: <dict> Address to balance
         """
 
-        last_block_index = len(chain)
+        with self.lock:
+            for address in self.addresses:
+                if height is None:
+                    self.address_to_balance[address] = index.address_balance(address)
+                else:
+                    self.address_to_balance[address] = index.address_balance_at_height(address, height)
 
-        for address in self.address_to_balance:
-            balance = Blockchain.address_balance_at_block_index(address, chain, last_block_index)
-            self.address_to_balance[address] = balance
+            return dict(self.address_to_balance)
 
     def generate_address(self):
         """
         Generate a new key pair and return the address.
         :return: address: <int> New address
         """
-        private_key = random_key()
-        public_key = privtopub(private_key)
-        address = pubtoaddr(public_key)
 
-        self.addresses.append(address)
-        self.address_to_keys[address] = [private_key, public_key]
-        self.address_to_balance[address] = 0
+        with self.lock:
+            address = self.add_key_pair(random_key())
+            self.save_private_keys()
 
         return address
 
@@ -65,7 +126,7 @@ class Wallet:
         :param sender: <str> Sender of the transaction
         :param recipient: <str> Recipient of the transaction
         :param amount: <int> Amount of coins
-        :return: signed_transaction: <dict> Signed transaction
+        :return: signed_transaction: <Transaction> Signed transaction
         """
 
         # Check if the wallet has a private key corresponding to the address
@@ -75,25 +136,9 @@ class Wallet:
         else:
             return None
 
-        transaction_content = {
-            'sender': sender,
-            'recipient': recipient,
-            'amount': amount
-        }
-
-        # Order the transaction to avoid inconsistent hashes
-        transaction_encoded = json.dumps(transaction_content, sort_keys=True).encode()
-        transaction_hash = hashlib.sha256(transaction_encoded).hexdigest()
+        signed_transaction = Transaction(sender, recipient, amount)
 
         # Create a valid digital signature for the transaction by using the Elliptic Curve Digital Signature Algorithm
-        signature = ecdsa_sign(transaction_hash, private_key)
-
-        # Create a transaction with a valid digital signature
-        signed_transaction = {
-            'sender': sender,
-            'recipient': recipient,
-            'amount': amount,
-            'signature': signature
-        }
+        signed_transaction.signature = ecdsa_sign(signed_transaction.signing_hash, private_key)
 
         return signed_transaction
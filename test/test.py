@@ -1,9 +1,22 @@
 from bitcoin import *
 from unittest import TestCase
-from time import time
+from time import sleep, time
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 
+from src import compression
+from src.block import Block, BlockHeader
+from src.block_template import BlockTemplateBuilder
 from src.blockchain import Blockchain
+from src.bloom_filter import BloomFilter
+from src.cache import ResponseCache
+from src.chain_store import ChainStore
+from src.chain_stream import iter_chain_blocks
+from src.mempool import Mempool
+from src.transaction import Transaction
 from src.wallet import Wallet
 from src.proof_of_work import ProofOfWork
 
@@ -163,7 +176,7 @@ class MainTestCase(TestCase):
         self.blockchain.create_block(nonce, previous_block_hash, self.mempool.current_transactions)
         created_block = self.blockchain.last_block
 
-        block_encoded = json.dumps(created_block, sort_keys=True).encode()
+        block_encoded = json.dumps(created_block.to_dict(), sort_keys=True).encode()
         block_hash = hashlib.sha256(block_encoded).hexdigest()
 
         self.assertEqual(len(self.blockchain.hash(created_block)), 64)
@@ -310,3 +323,772 @@ class MainTestCase(TestCase):
         self.blockchain.create_block(nonce, previous_block_hash, self.mempool.current_transactions)
 
         self.assertFalse(self.blockchain.valid_chain(self.blockchain.chain))
+
+    def test_snapshot_unaffected_by_new_block(self):
+        snapshot = self.blockchain.snapshot()
+        transactions_hash = self.mempool.hash([])
+        previous_block_hash = self.blockchain.hash(self.blockchain.last_block)
+        nonce = ProofOfWork.proof_of_work(transactions_hash, previous_block_hash)
+        self.blockchain.create_block(nonce, previous_block_hash, [])
+
+        self.assertEqual(len(snapshot), 1)
+        self.assertEqual(len(self.blockchain.snapshot()), 2)
+
+    def test_create_block_keeps_transactions_not_included(self):
+        signed_transaction = self.wallet.sign_transaction(self.initial_address,
+                                                          '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 0)
+        transactions_of_block = list(self.mempool.current_transactions)
+
+        # Transaction arrives after the transactions of the block were selected
+        self.mempool.add_transaction(signed_transaction, self.blockchain)
+
+        transactions_hash = self.mempool.hash(transactions_of_block)
+        previous_block_hash = self.blockchain.hash(self.blockchain.last_block)
+        nonce = ProofOfWork.proof_of_work(transactions_hash, previous_block_hash)
+        self.blockchain.create_block(nonce, previous_block_hash, transactions_of_block)
+
+        self.assertEqual(self.mempool.current_transactions, [signed_transaction])
+
+    def test_concurrent_mempool_admission(self):
+        wallet = Wallet()
+        addresses = [wallet.generate_address() for _ in range(8)]
+        transactions = [wallet.sign_transaction(address, '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 0)
+                        for address in addresses]
+
+        threads = [threading.Thread(target=self.mempool.add_transaction, args=(transaction, self.blockchain))
+                   for transaction in transactions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.mempool.current_transactions), len(transactions))
+
+    def test_block_serialization_matches_dict(self):
+        signed_transaction = self.wallet.sign_transaction(self.initial_address,
+                                                          '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 0)
+        coinbase_transaction = {
+            'sender': '0',
+            'recipient': self.initial_address,
+            'amount': 10
+        }
+        block_dict = {
+            'index': 2,
+            'timestamp': time(),
+            'nonce': 42,
+            'transactions_hash': self.mempool.hash([signed_transaction, coinbase_transaction]),
+            'previous_block_hash': self.blockchain.hash(self.blockchain.last_block),
+            'transactions': [signed_transaction.to_dict(), coinbase_transaction]
+        }
+        block = Block.from_dict(block_dict)
+
+        self.assertEqual(block.to_dict(), block_dict)
+        self.assertEqual(self.blockchain.hash(block), self.blockchain.hash(block_dict))
+        self.assertEqual(block['transactions'][1], coinbase_transaction)
+        self.assertNotIn('signature', block.transactions[1].to_dict())
+
+    def test_slotted_objects_have_no_dict(self):
+        transaction = Transaction('0', self.initial_address, 10)
+
+        self.assertFalse(hasattr(transaction, '__dict__'))
+        self.assertFalse(hasattr(self.blockchain.last_block, '__dict__'))
+
+    def test_lookup_indexes(self):
+        signed_transaction = self.wallet.sign_transaction(self.initial_address,
+                                                          '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 0)
+        self.mempool.add_transaction(signed_transaction, self.blockchain)
+        transactions_hash = self.mempool.hash(self.mempool.current_transactions)
+        previous_block_hash = self.blockchain.hash(self.blockchain.last_block)
+        nonce = ProofOfWork.proof_of_work(transactions_hash, previous_block_hash)
+        block = self.blockchain.create_block(nonce, previous_block_hash, self.mempool.current_transactions)
+
+        self.assertEqual(self.blockchain.index.block_by_hash(block.hash), (1, block))
+        self.assertEqual(self.blockchain.index.block_by_hash(previous_block_hash), (0, self.chain[0]))
+        self.assertIs(self.blockchain.index.block_by_height(1), block)
+        self.assertIsNone(self.blockchain.index.block_by_height(2))
+        self.assertIsNone(self.blockchain.index.block_by_hash('12345'))
+        self.assertEqual(self.blockchain.index.transactions_by_id(signed_transaction.txid),
+                         [(1, block, 0, signed_transaction)])
+        self.assertEqual(self.blockchain.index.transactions_by_id('12345'), [])
+
+    def test_lookup_indexes_keep_duplicate_transaction_ids(self):
+        blockchain = Blockchain(prune_depth=3)
+        for _ in range(3):
+            template = blockchain.block_template(self.initial_address)
+            nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+            blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+
+        # Every coinbase transaction to the same address has the same id
+        coinbase_transaction = blockchain.last_block.transactions[-1]
+        self.assertEqual([(height, position) for height, _, position, _ in
+                          blockchain.index.transactions_by_id(coinbase_transaction.txid)], [(1, 0), (2, 0), (3, 0)])
+
+        # Pruning drops only the locations of the pruned blocks
+        template = blockchain.block_template(self.initial_address)
+        nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+        blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+        self.assertEqual(blockchain.index.transaction_locations[coinbase_transaction.txid], [(2, 0), (3, 0), (4, 0)])
+
+    def test_lookup_indexes_rebuilt_after_chain_replacement(self):
+        coinbase_transaction = Transaction('0', self.initial_address, 10)
+        transactions_hash = self.mempool.hash([coinbase_transaction])
+        previous_block_hash = self.blockchain.hash(self.blockchain.last_block)
+        nonce = ProofOfWork.proof_of_work(transactions_hash, previous_block_hash)
+        replaced_block = self.blockchain.create_block(nonce, previous_block_hash, [coinbase_transaction])
+
+        other_blockchain = Blockchain()
+        other_blockchain.create_block(nonce=0, transactions_of_block=[])
+        with self.blockchain.lock:
+            self.blockchain.replace_chain(other_blockchain.chain)
+
+        self.assertIsNone(self.blockchain.index.block_by_hash(replaced_block.hash))
+        self.assertEqual(self.blockchain.index.transactions_by_id(coinbase_transaction.txid), [])
+        self.assertEqual(self.blockchain.index.block_by_hash(other_blockchain.last_block.hash),
+                         (1, other_blockchain.last_block))
+
+    def test_address_history_pagination(self):
+        other_address = '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD'
+        for _ in range(3):
+            coinbase_transaction = Transaction('0', self.initial_address, 10)
+            transactions_hash = self.mempool.hash([coinbase_transaction])
+            previous_block_hash = self.blockchain.hash(self.blockchain.last_block)
+            nonce = ProofOfWork.proof_of_work(transactions_hash, previous_block_hash)
+            self.blockchain.create_block(nonce, previous_block_hash, [coinbase_transaction])
+
+        signed_transaction = self.wallet.sign_transaction(self.initial_address, other_address, 4)
+        self.mempool.add_transaction(signed_transaction, self.blockchain)
+        transactions_hash = self.mempool.hash(self.mempool.current_transactions)
+        previous_block_hash = self.blockchain.hash(self.blockchain.last_block)
+        nonce = ProofOfWork.proof_of_work(transactions_hash, previous_block_hash)
+        self.blockchain.create_block(nonce, previous_block_hash, self.mempool.current_transactions)
+
+        index = self.blockchain.index
+        last_block_index = len(self.chain)
+        number, send, received = self.blockchain.address_transactions_at_block_index(self.initial_address,
+                                                                                     self.chain, last_block_index)
+
+        self.assertEqual(index.address_balance(self.initial_address),
+                         self.blockchain.address_balance_at_block_index(self.initial_address, self.chain,
+                                                                        last_block_index))
+        self.assertEqual(index.number_of_transactions(self.initial_address), number)
+
+        first_page, cursor = index.address_history(self.initial_address, limit=3)
+        second_page, last_cursor = index.address_history(self.initial_address, cursor=cursor, limit=3)
+        self.assertEqual(cursor, 3)
+        self.assertIsNone(last_cursor)
+        self.assertEqual([transaction for _, _, transaction in first_page + second_page], received + send)
+
+        sent_page, _ = index.address_history(self.initial_address, direction='sent')
+        self.assertEqual(sent_page, [(4, 0, signed_transaction)])
+        received_page, _ = index.address_history(other_address, direction='received')
+        self.assertEqual(received_page, [(4, 0, signed_transaction)])
+        self.assertEqual(index.address_history('unknown'), ([], None))
+
+    def test_response_cache_invalidated_by_new_tip(self):
+        cache = ResponseCache(max_entries=2)
+        tip_hash = self.blockchain.last_block.hash
+
+        self.assertIsNone(cache.get(('chain',), tip_hash))
+        cache.put(('chain',), tip_hash, b'chain')
+        self.assertEqual(cache.get(('chain',), tip_hash), b'chain')
+
+        transactions_hash = self.mempool.hash([])
+        nonce = ProofOfWork.proof_of_work(transactions_hash, tip_hash)
+        self.blockchain.create_block(nonce, tip_hash, [])
+        new_tip_hash = self.blockchain.last_block.hash
+
+        self.assertIsNone(cache.get(('chain',), new_tip_hash))
+        self.assertNotEqual(cache.etag(('chain',), tip_hash), cache.etag(('chain',), new_tip_hash))
+
+        # A response built for the old tip must not be cached for the new one
+        cache.put(('chain',), tip_hash, b'chain')
+        self.assertIsNone(cache.get(('chain',), new_tip_hash))
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 3, 0))
+
+    def test_response_cache_eviction(self):
+        cache = ResponseCache(max_entries=2)
+        tip_hash = self.blockchain.last_block.hash
+        cache.get(('mempool', 0), tip_hash)
+        for version in range(3):
+            cache.put(('mempool', version), tip_hash, b'mempool')
+
+        self.assertIsNone(cache.get(('mempool', 0), tip_hash))
+        self.assertEqual(cache.get(('mempool', 2), tip_hash), b'mempool')
+
+    def test_network_backoff_and_selection(self):
+        self.network.max_active_peers = 2
+        for node in ('http://192.168.0.1:5000', 'http://192.168.0.2:5000', 'http://192.168.0.3:5000'):
+            self.network.register_node(node)
+
+        self.network.record_success('192.168.0.1:5000', 0.5, 10)
+        self.network.record_success('192.168.0.2:5000', 0.1, 12)
+        self.network.record_failure('192.168.0.3:5000')
+        self.network.record_failure('192.168.0.3:5000')
+
+        # The failing peer backs off exponentially and is not contacted
+        peer = self.network.nodes['192.168.0.3:5000']
+        self.assertEqual(peer.failures, 2)
+        self.assertAlmostEqual(peer.retry_at - time(), 2 * self.network.BACKOFF, delta=0.5)
+        self.assertEqual(self.network.active_peers(), ['192.168.0.2:5000', '192.168.0.1:5000'])
+
+        # Only peers with a longer chain are sync candidates, highest first
+        self.assertEqual(self.network.sync_candidates(['192.168.0.1:5000', '192.168.0.2:5000'], 10),
+                         [('192.168.0.2:5000', 12), ('192.168.0.1:5000', 10)])
+        self.assertEqual(self.network.sync_candidates(['192.168.0.1:5000', '192.168.0.2:5000'], 12),
+                         [('192.168.0.2:5000', 12)])
+
+        # A success resets the backoff
+        self.network.record_success('192.168.0.3:5000', 0.2, 3)
+        self.assertEqual(self.network.nodes['192.168.0.3:5000'].failures, 0)
+        self.assertEqual(len(self.network.active_peers()), 2)
+
+    def test_consensus_with_unreachable_node(self):
+        self.network.register_node('http://127.0.0.1:1')
+
+        self.assertFalse(self.blockchain.reach_consensus())
+        self.assertEqual(self.network.nodes['127.0.0.1:1'].failures, 1)
+        self.assertEqual(self.network.active_peers(), [])
+
+    def start_stub_peer(self, handler):
+        server = HTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return f'127.0.0.1:{server.server_port}'
+
+    def test_consensus_with_malformed_peer_status(self):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(b'{"height": "5", "pruned_height": -1}')
+
+            def log_message(self, *args):
+                pass
+
+        node = self.start_stub_peer(Handler)
+        self.network.register_node(f'http://{node}')
+
+        self.assertFalse(self.blockchain.reach_consensus())
+        self.assertEqual(self.network.nodes[node].failures, 1)
+        self.assertIsNone(self.network.nodes[node].height)
+
+    def forged_headers(self, number_of_headers):
+        # Headers claim any hash, so each one only needs a cheap Proof of Work over its own fields
+        headers = [BlockHeader(1, 0, 0, '0' * 64, '0' * 64, 'forged0')]
+        for index in range(2, number_of_headers + 1):
+            transactions_hash = Mempool.hash([])
+            nonce = ProofOfWork.proof_of_work(transactions_hash, headers[-1].hash)
+            headers.append(BlockHeader(index, 0, nonce, transactions_hash, headers[-1].hash, f'forged{index}'))
+        return headers
+
+    def test_consensus_rejects_forged_headers(self):
+        self.mine_blocks(2)
+        headers = self.forged_headers(10)
+        self.assertFalse(self.blockchain.valid_chain(headers))
+        self.assertFalse(self.blockchain.valid_chain([self.chain[0]] + headers[1:]))
+
+        body = json.dumps({'chain': [header.to_dict() for header in headers], 'length': len(headers)}).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                if self.path == '/node/status':
+                    self.wfile.write(b'{"height": 9, "pruned_height": -1}')
+                else:
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        node = self.start_stub_peer(Handler)
+        self.network.register_node(f'http://{node}')
+
+        self.assertFalse(self.blockchain.reach_consensus())
+        self.assertEqual(len(self.blockchain.chain), 3)
+        self.assertEqual(self.blockchain.index.address_balance(self.initial_address), 20)
+
+    def test_consensus_abandons_slow_peer(self):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if self.path == '/node/status':
+                    self.end_headers()
+                    self.wfile.write(b'{"height": 1000000, "pruned_height": -1}')
+                    return
+
+                # Advertise a large chain and send the start of it a byte at a time for up to ten seconds
+                self.send_header('Content-Length', '100000000')
+                self.end_headers()
+                try:
+                    for byte in b'{"chain": [' * 18:
+                        self.wfile.write(bytes([byte]))
+                        self.wfile.flush()
+                        sleep(0.05)
+                except OSError:
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        node = self.start_stub_peer(Handler)
+        self.network.register_node(f'http://{node}')
+        self.network.download_timeout = 0.5
+
+        start = time()
+        self.assertFalse(self.blockchain.reach_consensus())
+        self.assertLess(time() - start, 2)
+        self.assertEqual(self.network.nodes[node].failures, 1)
+
+        # The connection was closed, so the download thread does not wait for the next byte of the peer
+        sleep(0.5)
+        self.assertNotIn(f'download {node}', [thread.name for thread in threading.enumerate()])
+
+    def test_block_template_submission(self):
+        signed_transaction = self.wallet.sign_transaction(self.initial_address,
+                                                          '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 0)
+        self.mempool.add_transaction(signed_transaction, self.blockchain)
+        template = self.blockchain.block_template(self.initial_address)
+
+        self.assertEqual(template.previous_block_hash, self.blockchain.last_block.hash)
+        self.assertEqual(template.transactions[0], signed_transaction)
+        self.assertEqual(template.transactions[-1].recipient, self.initial_address)
+
+        block, error = self.blockchain.submit_block(template.transactions_hash, template.previous_block_hash, 12345)
+        self.assertIsNone(block)
+        self.assertEqual(error, 'Invalid proof of work!')
+
+        nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+        block, error = self.blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+        self.assertIsNone(error)
+        self.assertIs(block, self.blockchain.last_block)
+        self.assertEqual(block.transactions_hash, template.transactions_hash)
+        self.assertFalse(self.mempool.current_transactions)
+        self.assertTrue(self.blockchain.valid_chain(self.chain))
+
+        # A second solution for the same template builds on a block which is no longer the last one
+        block, error = self.blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+        self.assertIsNone(block)
+
+    def test_block_template_stale(self):
+        template = self.blockchain.block_template(self.initial_address)
+        other_template = self.blockchain.block_template('14peaf2JegQP5nmNQESAdpRGLbse8JqgJD')
+
+        nonce = ProofOfWork.proof_of_work(other_template.transactions_hash, other_template.previous_block_hash)
+        self.blockchain.submit_block(other_template.transactions_hash, other_template.previous_block_hash, nonce)
+
+        nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+        block, error = self.blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+        self.assertIsNone(block)
+        self.assertEqual(len(self.chain), 2)
+
+    def test_chain_replacement_revalidates_mempool(self):
+        self.mine_blocks(1)
+        other = Blockchain()
+        with other.lock:
+            other.replace_chain(list(self.chain))
+
+        # The payment is mined on the other chain, the spend of all coins is invalid on a chain without them
+        payment = self.wallet.sign_transaction(self.initial_address, '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 5)
+        self.assertTrue(self.mempool.add_transaction(payment, self.blockchain))
+        self.assertTrue(other.mempool.add_transaction(payment, other))
+        template = other.block_template(self.initial_address)
+        nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+        other.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+        other.create_block(nonce=0, transactions_of_block=[])
+
+        stale_template = self.blockchain.block_template(self.initial_address)
+        with self.blockchain.lock:
+            self.blockchain.replace_chain(other.chain)
+        self.assertFalse(self.mempool.current_transactions)
+        block, error = self.blockchain.submit_block(stale_template.transactions_hash,
+                                                    stale_template.previous_block_hash, 0)
+        self.assertEqual(error, 'Unknown block template!')
+
+        spend = self.wallet.sign_transaction(self.initial_address, '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 15)
+        self.assertTrue(self.mempool.add_transaction(spend, self.blockchain))
+        with self.blockchain.lock:
+            self.blockchain.replace_chain(Blockchain().chain)
+        self.assertFalse(self.mempool.current_transactions)
+
+    def test_proof_of_work_split_search(self):
+        transactions_hash = self.mempool.hash([])
+        previous_block_hash = self.blockchain.hash(self.blockchain.last_block)
+        nonce = ProofOfWork.proof_of_work(transactions_hash, previous_block_hash)
+
+        self.assertEqual(ProofOfWork.proof_of_work(transactions_hash, previous_block_hash, nonce % 2, 2), nonce)
+        self.assertIsNone(ProofOfWork.proof_of_work(transactions_hash, previous_block_hash, 0, 1, nonce))
+
+    def mine_blocks(self, number_of_blocks):
+        for _ in range(number_of_blocks):
+            template = self.blockchain.block_template(self.initial_address)
+            nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+            self.blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+
+    def test_iter_chain_blocks(self):
+        self.mine_blocks(3)
+        body = json.dumps({'chain': [block.to_dict() for block in self.chain], 'length': len(self.chain)},
+                          sort_keys=True, indent=2).encode()
+
+        for chunk_size in (1, 7, 64, len(body)):
+            chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+            blocks = [Block.from_dict(block) for block in iter_chain_blocks(chunks)]
+            self.assertEqual([block.hash for block in blocks], [block.hash for block in self.chain])
+
+        with self.assertRaises(ValueError):
+            list(iter_chain_blocks([body[:len(body) // 2]]))
+        with self.assertRaises(ValueError):
+            list(iter_chain_blocks([b'{"chain": [1, 2]}']))
+
+    def test_download_chain_abandons_invalid_peer(self):
+        self.mine_blocks(3)
+        blocks = [block.to_dict() for block in self.chain]
+        blocks[2]['nonce'] = 12345
+        body = json.dumps({'chain': blocks, 'length': len(blocks)}, sort_keys=True).encode()
+        valid_body = json.dumps({'chain': [block.to_dict() for block in self.chain], 'length': len(blocks)},
+                                sort_keys=True).encode()
+        served = {'/chain': body}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(served[self.path])
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        node = f'127.0.0.1:{server.server_port}'
+
+        try:
+            self.assertIsNone(Blockchain().download_chain(node))
+            served['/chain'] = valid_body
+            chain = Blockchain().download_chain(node)
+            self.assertEqual([block.hash for block in chain], [block.hash for block in self.chain])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_valid_chain_rejects_overspending(self):
+        self.mine_blocks(1)
+
+        # Spend the same coins twice in consecutive blocks
+        for _ in range(2):
+            signed_transaction = self.wallet.sign_transaction(self.initial_address,
+                                                              '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 10)
+            self.mempool.current_transactions.append(signed_transaction)
+            transactions_hash = self.mempool.hash(self.mempool.current_transactions)
+            previous_block_hash = self.blockchain.hash(self.blockchain.last_block)
+            nonce = ProofOfWork.proof_of_work(transactions_hash, previous_block_hash)
+            self.blockchain.create_block(nonce, previous_block_hash, self.mempool.current_transactions)
+
+        self.assertTrue(self.blockchain.valid_chain(self.chain[:3]))
+        self.assertFalse(self.blockchain.valid_chain(self.chain))
+
+    def test_pruned_mode_keeps_headers_and_state(self):
+        blockchain = Blockchain(prune_depth=2)
+        for _ in range(5):
+            template = blockchain.block_template(self.initial_address)
+            nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+            blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+
+        signed_transaction = self.wallet.sign_transaction(self.initial_address,
+                                                          '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 45)
+        self.assertTrue(blockchain.mempool.add_transaction(signed_transaction, blockchain))
+
+        template = blockchain.block_template(self.initial_address)
+        nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+        blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+
+        self.assertEqual(len(blockchain.chain), 7)
+        self.assertEqual(blockchain.pruned_height, 4)
+        self.assertTrue(all(isinstance(block, BlockHeader) for block in blockchain.chain[:5]))
+        self.assertTrue(all(block.transactions for block in blockchain.chain[5:]))
+
+        # The chain stays linked through the stored hashes
+        for previous_block, block in zip(blockchain.chain, blockchain.chain[1:]):
+            self.assertEqual(block.previous_block_hash, previous_block.hash)
+
+        # Balances survive pruning, the history only contains retained transactions
+        index = blockchain.index
+        self.assertEqual(index.address_balance(self.initial_address), 15)
+        self.assertEqual(index.number_of_transactions(self.initial_address), 7)
+        transactions, next_cursor = index.address_history(self.initial_address)
+        self.assertEqual([(height, position) for height, position, _ in transactions], [(5, 0), (6, 0), (6, 1)])
+        self.assertIsNone(next_cursor)
+        self.assertEqual([location[0] for location in index.transactions_by_id(signed_transaction.txid)], [6])
+
+        # The pruned chain is valid with the balances after the pruned blocks and rejected without them
+        self.assertTrue(blockchain.valid_chain(blockchain.chain, index.pruned_balances()))
+        self.assertFalse(blockchain.valid_chain(blockchain.chain))
+        # Pruned blocks cannot follow blocks with transactions
+        self.assertFalse(blockchain.valid_chain(blockchain.chain[:6] + [blockchain.chain[6].header()],
+                                                index.pruned_balances()))
+        for block in blockchain.chain[:5]:
+            self.assertIsInstance(Block.from_dict(block.to_dict()), BlockHeader)
+
+    def test_index_publishes_tip_after_indexing(self):
+        self.mine_blocks(2)
+        index = self.blockchain.index
+        self.assertEqual(index.tip, (2, self.blockchain.last_block.hash))
+
+        # A block appended to the chain but not indexed yet is not visible at the tip
+        block = Block(4, 0, 0, Mempool.hash([]), self.blockchain.last_block.hash,
+                      [Transaction('0', self.initial_address, 10, 'coinbase transaction')])
+        self.chain.append(block)
+        self.assertEqual(len(index.snapshot(index.tip[0])), 3)
+        self.assertEqual(index.number_of_transactions(self.initial_address), 2)
+        transactions, next_cursor = index.address_history(self.initial_address)
+        self.assertEqual([height for height, _, _ in transactions], [1, 2])
+        self.assertIsNone(next_cursor)
+
+        index.add_block(block, 3)
+        self.assertEqual(index.tip, (3, block.hash))
+        self.assertEqual(index.number_of_transactions(self.initial_address), 3)
+
+    def test_pruning_keeps_snapshots_intact(self):
+        self.blockchain = Blockchain(prune_depth=1)
+        self.mine_blocks(2)
+        snapshot = self.blockchain.snapshot()
+        chain = self.blockchain.chain
+        index = self.blockchain.index
+        posting_list = index.address_postings[self.initial_address]['all']
+        checkpoints = index.balance_checkpoints[self.initial_address]
+
+        self.mine_blocks(1)
+        self.assertIsInstance(self.blockchain.chain[2], BlockHeader)
+        self.assertIs(self.blockchain.index.chain, self.blockchain.chain)
+        # Readers which took the chain before keep the full blocks
+        self.assertTrue(snapshot[2].transactions)
+        self.assertTrue(chain[2].transactions)
+
+        # Pruned entries are dropped from new lists, the lists readers hold are only appended to
+        self.assertEqual((posting_list.pruned, posting_list.locations), (1, [(2, 0), (3, 0)]))
+        self.assertEqual(checkpoints, [(1, 10), (2, 20), (3, 30)])
+        self.assertEqual(index.address_postings[self.initial_address]['all'].pruned, 2)
+        self.assertEqual(index.balance_checkpoints[self.initial_address], [(2, 20), (3, 30)])
+
+    def test_balance_checkpoints_compacted_when_pruned(self):
+        blockchain = Blockchain(prune_depth=2)
+        for _ in range(6):
+            template = blockchain.block_template(self.initial_address)
+            nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+            blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+
+        index = blockchain.index
+        self.assertEqual(index.pruned_height, 4)
+        # One checkpoint up to the pruned height and one per retained block
+        self.assertEqual(index.balance_checkpoints[self.initial_address], [(4, 40), (5, 50), (6, 60)])
+        self.assertEqual(index.address_balance_at_height(self.initial_address, 4), 40)
+        self.assertEqual(index.address_balance_at_height(self.initial_address, 6), 60)
+        self.assertIsNone(index.address_balance_at_height(self.initial_address, 3))
+        self.assertEqual(index.balance_history(self.initial_address, 5), (40, [(5, 50), (6, 60)], None))
+        self.assertEqual(index.balance_history(self.initial_address, 2), (None, [], None))
+
+    def test_compression_negotiation(self):
+        self.assertEqual(compression.negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(compression.negotiate('br;q=1.0, gzip;q=0.5'), 'gzip')
+        self.assertIsNone(compression.negotiate('gzip;q=0'))
+        self.assertIsNone(compression.negotiate(None))
+        self.assertEqual(compression.negotiate(compression.accept_encoding()), compression.ENCODINGS[0])
+
+    def test_compression_round_trip_in_chunks(self):
+        self.mine_blocks(2)
+        body = json.dumps({'chain': [block.to_dict() for block in self.chain], 'length': len(self.chain)},
+                          sort_keys=True).encode()
+
+        for encoding in compression.ENCODINGS:
+            compressed = compression.compress(body, encoding)
+            chunks = [compressed[i:i + 16] for i in range(0, len(compressed), 16)]
+
+            self.assertLess(len(compressed), len(body))
+            self.assertEqual(b''.join(compression.decompress_chunks(chunks, encoding)), body)
+            blocks = list(iter_chain_blocks(compression.decompress_chunks(chunks, encoding)))
+            self.assertEqual(len(blocks), len(self.chain))
+
+        with self.assertRaises(ValueError):
+            list(compression.decompress_chunks([b'not compressed'], 'gzip'))
+        with self.assertRaises(ValueError):
+            list(compression.decompress_chunks([body], 'br'))
+
+    def test_bloom_filter(self):
+        bloom_filter = BloomFilter.for_capacity(100)
+        addresses = [self.wallet.generate_address() for _ in range(20)]
+        for address in addresses:
+            bloom_filter.add(address)
+
+        self.assertTrue(all(address in bloom_filter for address in addresses))
+        self.assertNotIn('14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', bloom_filter)
+
+        restored = BloomFilter.from_dict(bloom_filter.to_dict())
+        self.assertEqual(restored.bits, bloom_filter.bits)
+        with self.assertRaises(ValueError):
+            BloomFilter.from_dict(dict(bloom_filter.to_dict(), size=7))
+
+    def test_wallet_balances_from_index(self):
+        self.blockchain = Blockchain(prune_depth=1)
+        self.mine_blocks(3)
+        self.assertEqual(self.wallet.update_balances(self.blockchain.index), {self.initial_address: 30})
+        self.assertEqual(self.wallet.total_balance(), 30)
+
+        # The balances of a replaced chain are taken from its index
+        other = Blockchain()
+        template = other.block_template('14peaf2JegQP5nmNQESAdpRGLbse8JqgJD')
+        nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+        other.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+        self.wallet.update_balances(other.index)
+        self.assertEqual(self.wallet.total_balance(), 0)
+
+    def test_matching_transactions(self):
+        self.mine_blocks(3)
+        bloom_filter = BloomFilter.for_capacity(10)
+        bloom_filter.add(self.initial_address)
+
+        transactions, next_height = self.blockchain.index.matching_transactions(bloom_filter, 2)
+        self.assertEqual([(height, position) for height, position, _ in transactions], [(2, 0), (3, 0)])
+        self.assertEqual(next_height, 4)
+
+        transactions, next_height = self.blockchain.index.matching_transactions(BloomFilter.for_capacity(10))
+        self.assertEqual((transactions, next_height), ([], 4))
+
+    def test_balance_at_height(self):
+        self.mine_blocks(3)
+        signed_transaction = self.wallet.sign_transaction(self.initial_address,
+                                                          '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 25)
+        self.assertTrue(self.mempool.add_transaction(signed_transaction, self.blockchain))
+        self.mine_blocks(2)
+
+        index = self.blockchain.index
+        for height in range(len(self.chain)):
+            self.assertEqual(index.address_balance_at_height(self.initial_address, height),
+                             self.blockchain.address_balance_at_block_index(self.initial_address, self.chain,
+                                                                           height + 1))
+        self.assertEqual(index.address_balance_at_height('14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 3), 0)
+        self.assertEqual(index.address_balance_at_height('14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', 4), 25)
+
+        opening_balance, changes, next_height = index.balance_history(self.initial_address, 2, limit=2)
+        self.assertEqual((opening_balance, changes, next_height), (10, [(2, 20), (3, 30)], 4))
+        opening_balance, changes, next_height = index.balance_history(self.initial_address, next_height, limit=2)
+        self.assertEqual((opening_balance, changes, next_height), (30, [(4, 15), (5, 25)], None))
+
+    def test_block_template_limits_and_priority(self):
+        for priority, expected_amounts in (('arrival', [3, 7]), ('amount', [7, 5])):
+            blockchain = Blockchain(max_block_transactions=3, block_priority=priority)
+            senders = [self.wallet.generate_address() for _ in range(3)]
+            for sender in senders:
+                template = blockchain.block_template(sender)
+                nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+                blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+
+            for sender, amount in zip(senders, (3, 7, 5)):
+                signed_transaction = self.wallet.sign_transaction(sender, '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', amount)
+                self.assertTrue(blockchain.mempool.add_transaction(signed_transaction, blockchain))
+
+            template = blockchain.block_template(self.initial_address)
+            self.assertEqual([transaction.amount for transaction in template.transactions[:-1]], expected_amounts)
+            self.assertEqual(template.transactions_hash, blockchain.mempool.hash(template.transactions))
+
+            nonce = ProofOfWork.proof_of_work(template.transactions_hash, template.previous_block_hash)
+            blockchain.submit_block(template.transactions_hash, template.previous_block_hash, nonce)
+            self.assertEqual(len(blockchain.mempool.current_transactions), 1)
+            self.assertTrue(blockchain.valid_chain(blockchain.chain))
+
+            # The leftover transaction goes into the next block
+            template = blockchain.block_template(self.initial_address)
+            self.assertEqual(len(template.transactions), 2)
+            self.assertEqual(template.transactions_hash, blockchain.mempool.hash(template.transactions))
+
+    def test_block_template_builder_incremental_hash(self):
+        transactions = [Transaction(str(i), '14peaf2JegQP5nmNQESAdpRGLbse8JqgJD', i, 'signature') for i in range(6)]
+        coinbase_transaction = Transaction('0', self.initial_address, 10, 'coinbase transaction')
+        builder = BlockTemplateBuilder(max_bytes=400)
+
+        template = builder.build(2, 'hash', transactions[:2], coinbase_transaction)
+        self.assertEqual(template.transactions_hash, Mempool.hash(template.transactions))
+
+        # New transactions are appended to the kept selection until the byte limit is reached
+        template = builder.build(2, 'hash', transactions, coinbase_transaction)
+        self.assertEqual(template.transactions_hash, Mempool.hash(template.transactions))
+        self.assertLessEqual(len(json.dumps([t.to_dict() for t in template.transactions], sort_keys=True)), 400)
+        self.assertLess(len(template.transactions), 7)
+
+        template = builder.build(3, 'hash', transactions[3:], coinbase_transaction)
+        self.assertIs(template.transactions[0], transactions[3])
+        self.assertEqual(template.transactions_hash, Mempool.hash(template.transactions))
+
+    def test_chain_store_shared_by_writer_and_reader(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            writer = Blockchain(store=ChainStore(data_dir))
+            reader = Blockchain()
+            reader_store = ChainStore(data_dir)
+
+            reader_store.sync(reader)
+            self.assertEqual([block.hash for block in reader.chain], [block.hash for block in writer.chain])
+
+            self.blockchain = writer
+            self.mine_blocks(2)
+            reader_store.sync(reader)
+            self.assertEqual([block.hash for block in reader.chain], [block.hash for block in writer.chain])
+            self.assertEqual(reader.index.address_balance(self.initial_address), 20)
+
+            # A replaced chain is picked up as a whole
+            with writer.lock:
+                writer.replace_chain(writer.chain[:2])
+            reader_store.sync(reader)
+            self.assertEqual(len(reader.chain), 2)
+
+            # A restarted writer continues with the stored chain, a partially written block is dropped
+            with open(reader_store.path, 'ab') as file:
+                file.write(b'{"index": 3')
+            restarted = Blockchain(store=ChainStore(data_dir))
+            self.assertEqual([block.hash for block in restarted.chain], [block.hash for block in reader.chain])
+            self.assertTrue(restarted.valid_chain(restarted.chain))
+
+    def test_chain_store_compacted_when_pruned(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            store = ChainStore(data_dir)
+            store.COMPACT_INTERVAL = 3
+            self.blockchain = Blockchain(prune_depth=2, store=store)
+            self.mine_blocks(6)
+
+            # The file was rewritten with the headers of the first three blocks after the state line
+            with open(store.path) as file:
+                lines = [json.loads(line) for line in file]
+            self.assertEqual(lines[0]['state']['pruned_height'], 2)
+            self.assertEqual(['transactions' in line for line in lines[1:]], [False] * 3 + [True] * 4)
+
+            postings = self.blockchain.index.address_postings[self.initial_address]
+            for restarted in (Blockchain(prune_depth=2, store=ChainStore(data_dir)), Blockchain(prune_depth=2)):
+                if restarted.store is None:
+                    ChainStore(data_dir).sync(restarted)
+
+                self.assertEqual([block.hash for block in restarted.chain],
+                                 [block.hash for block in self.blockchain.chain])
+                self.assertEqual(restarted.pruned_height, 4)
+                index = restarted.index
+                self.assertEqual(index.address_balance(self.initial_address), 60)
+                self.assertEqual(index.balance_checkpoints[self.initial_address], [(4, 40), (5, 50), (6, 60)])
+                self.assertEqual({direction: len(posting_list) for direction, posting_list in
+                                  index.address_postings[self.initial_address].items()},
+                                 {direction: len(posting_list) for direction, posting_list in postings.items()})
+                self.assertTrue(restarted.valid_chain(restarted.chain, index.pruned_balances()))
+
+    def test_wallet_keys_persisted(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = os.path.join(data_dir, 'wallet.json')
+            wallet = Wallet(path)
+            wallet.generate_address()
+
+            restarted = Wallet(path)
+            self.assertEqual(restarted.addresses, wallet.addresses)
+            self.assertEqual(restarted.address_to_keys, wallet.address_to_keys)
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)